@@ -0,0 +1,69 @@
+# Cluster-load-aware admission of Spark jobs
+import random
+import requests
+
+# Livy batches in these states are not YARN applications yet
+LIVY_STARTING_STATES = ('not_started', 'starting')
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """
+    Exponential backoff with equal jitter, in seconds
+    """
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class AdmissionController:
+    """
+    Decides how many new Spark applications the cluster can take, from the
+    YARN ResourceManager metrics and the Livy batches still starting.
+    Limits left as None are not checked. If the metrics can't be read the
+    controller fails open, so a busy ResourceManager never stalls the chain.
+    """
+
+    def __init__(self, host: str, livy_client=None, port: int = 8088,
+            max_running_apps: int = None, max_pending_containers: int = None,
+            min_available_mb: int = None, timeout: float = 5):
+        self.url = f"http://{host}:{port}/ws/v1/cluster/metrics"
+        self.livy_client = livy_client
+        self.max_running_apps = max_running_apps
+        self.max_pending_containers = max_pending_containers
+        self.min_available_mb = min_available_mb
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def metrics(self) -> dict:
+        response = self.session.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['clusterMetrics']
+
+    def starting_batches(self) -> int:
+        if self.livy_client is None:
+            return 0
+        return len([batch for batch in self.livy_client.list_batches()
+            if batch['state'] in LIVY_STARTING_STATES])
+
+    def capacity(self):
+        """
+        Number of applications that can be submitted now, None if unlimited
+        """
+        try:
+            metrics = self.metrics()
+            starting = self.starting_batches()
+        except Exception as e:
+            print(f"Could not read cluster load, admitting everything: {e}")
+            return None
+
+        print(f"Cluster load: {metrics['appsRunning']} running, {metrics['appsPending']} pending apps, "
+            f"{starting} starting batches, {metrics['containersPending']} pending containers, "
+            f"{metrics['availableMB']}MB available")
+
+        if self.max_pending_containers is not None \
+                and metrics['containersPending'] > self.max_pending_containers:
+            return 0
+        if self.min_available_mb is not None and metrics['availableMB'] < self.min_available_mb:
+            return 0
+        if self.max_running_apps is None:
+            return None
+
+        active = metrics['appsRunning'] + metrics['appsPending'] + starting
+        return max(0, self.max_running_apps - active)
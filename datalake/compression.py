@@ -0,0 +1,57 @@
+# Output codecs for the text landed in S3
+import bz2
+import zlib
+
+class Identity:
+    """
+    Compressor-like object that leaves data as is
+    """
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b''
+
+class Codec:
+    """
+    A named way of compressing output. `extension` is appended to object
+    keys, so that Hadoop input formats pick the matching decompressor, and
+    `table_type` goes in the compressionType table parameter. `factory`
+    takes a compression level and returns an object with the compress and
+    flush methods of zlib compressors
+    """
+
+    def __init__(self, name: str, extension: str, table_type: str, factory, default_level: int):
+        self.name = name
+        self.extension = extension
+        self.table_type = table_type
+        self.factory = factory
+        self.default_level = default_level
+
+    @property
+    def compressed(self) -> bool:
+        return self.extension != ''
+
+    def compressor(self, level: int = None):
+        return self.factory(self.default_level if level is None else level)
+
+CODECS = {}
+
+def register(codec: Codec):
+    CODECS[codec.name] = codec
+
+register(Codec('none', '', 'none', lambda level: Identity(), 0))
+# wbits 31 writes a gzip header and trailer rather than a bare zlib stream
+register(Codec('gzip', '.gz', 'gzip',
+    lambda level: zlib.compressobj(level, zlib.DEFLATED, 31), 6))
+register(Codec('bzip2', '.bz2', 'bzip2', bz2.BZ2Compressor, 9))
+
+def get_codec(name: str = None) -> Codec:
+    """
+    Look up a codec by name, no name meaning no compression
+    """
+    try:
+        return CODECS[name or 'none']
+    except KeyError:
+        raise ValueError(f"Unknown output codec {name}, expected one of {', '.join(sorted(CODECS))}")
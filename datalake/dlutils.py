@@ -1,7 +1,11 @@
+import json
 import monitoring
-import requests
+import os
 
-from pyutils import EnvObject
+from admission import AdmissionController
+from concurrent.futures import ThreadPoolExecutor
+from livy import LivyClient, SessionPool, scala_main_call
+from pyutils import EnvObject, pick
 env = EnvObject()
 
 interfaces = {
@@ -56,6 +60,11 @@ interfaces = {
 }
 
 
+# Fields identifying a partition within a coalesced step payload
+PARTITION_FIELDS = ['system', 'country', 'year', 'month', 'day', 'secs',
+    'execution_id', 'attempt']
+
+
 map_steps = {
     'initial': 'load_parquet_partition',
     'load_parquet_partition': 'load_redshift_partition',
@@ -64,6 +73,9 @@ map_steps = {
     'load_functional_redshift': 'final'
 }
 
+# Step with nothing to do for interfaces converted to Parquet at ingestion
+converted_step = 'load_parquet_partition'
+
 
 def get_jdbc():
     return "".join([
@@ -89,8 +101,25 @@ def get_base_livy_payload(class_name):
     }
 
 
+def partition_task(task, ingested, converted=()):
+    """
+    Task queued for a partition, naming the interfaces ingested, which
+    per-interface steps run for, and those converted to Parquet, so that
+    Spark skips them
+    """
+    task = dict(task, interfaces=sorted(ingested))
+    if converted:
+        task['parquet_interfaces'] = sorted(converted)
+    return task
+
 
 def get_spark_command_partition(task_data, step, extra_args = None):
+    # Fanned out steps only process their interface and call back with
+    # their DAG node as step id
+    step_id = step
+    if task_data.get('interface'):
+        step_id = f"{step}:{task_data['interface']}"
+
     args = [
         "--process-all", "--skip-failures", 
         "--glue-staging-database", env.glue_staging_db,
@@ -102,7 +131,7 @@ def get_spark_command_partition(task_data, step, extra_args = None):
         "--day", task_data['day'], "--secs", task_data['secs'],
         "--execution-id", task_data['execution_id'],
         "--attempt", str(task_data['attempt']),
-        "--tempS3Dir", env.s3_temp_dir, "--step-id", step,
+        "--tempS3Dir", env.s3_temp_dir, "--step-id", step_id,
         "--jdbc", get_jdbc(), "--lambda-callback", env.function_name,
         "--lock-table", env.emr_lock_table
     ]
@@ -111,18 +140,54 @@ def get_spark_command_partition(task_data, step, extra_args = None):
     if monitoring_settings.monitoring_topic:
         args.extend(["--monitoring-topic", monitoring_settings.monitoring_topic])
 
+    if task_data.get('interface'):
+        args.remove("--process-all")
+        args.extend(["--interface", task_data['interface']])
+
+    # Coalesced payloads carry every partition to process
+    if task_data.get('partitions'):
+        args.extend(["--partitions", json.dumps([pick(task, *PARTITION_FIELDS)
+            for task in task_data['partitions']])])
+
     if extra_args:
         args.extend(extra_args)
 
     return args
 
 
-def get_glue_table(glue, database_name, table_name):
-    try:
-        response = glue.get_table(DatabaseName=database_name, Name=table_name)
-        return response['Table']
-    except glue.exceptions.EntityNotFoundException:
-        return False
+def get_payload_tasks(payload):
+    """
+    Tasks covered by a step payload, several when partitions were coalesced
+    """
+    return payload.get('partitions') or [payload]
+
+
+def coalesce_tasks(tasks, max_partitions):
+    """
+    Group tasks of the same system (and interface, for fanned out steps,
+    and interfaces already converted to Parquet) into step payloads
+    covering up to `max_partitions` partitions each.
+    The first task of a group provides the single partition arguments,
+    the whole group goes in 'partitions' and the job is expected to call
+    back with a result per partition
+    """
+    by_system = {}
+    for task in tasks:
+        task = {key: value for key, value in task.items() if key != 'partitions'}
+        key = (task['system'], task.get('interface'), tuple(task.get('parquet_interfaces') or ()))
+        by_system.setdefault(key, []).append(task)
+
+    payloads = []
+    size = max(max_partitions, 1)
+    for system_tasks in by_system.values():
+        for start in range(0, len(system_tasks), size):
+            group = system_tasks[start:start + size]
+            if len(group) == 1:
+                payloads.append(group[0])
+            else:
+                payloads.append(dict(group[0], partitions=group))
+
+    return payloads
 
 
 def get_queue_name(prefix, env, project, fifo=True):
@@ -133,7 +198,12 @@ def get_queue_name(prefix, env, project, fifo=True):
 
 def get_load_parquet_partition_request(payload):
     base = get_base_livy_payload('LoadToParquet')
-    base['args'] = get_spark_command_partition(payload, 'load_parquet_partition')
+    # Interfaces converted to Parquet at ingestion don't need the job
+    extra_args = None
+    if payload.get('parquet_interfaces'):
+        extra_args = ["--skip-interfaces", ",".join(payload['parquet_interfaces'])]
+    base['args'] = get_spark_command_partition(payload, 'load_parquet_partition',
+        extra_args=extra_args)
 
     return base
 
@@ -161,6 +231,15 @@ def get_load_functional_redshift_request(payload):
     return base
 
 
+def get_livy_session_payload():
+    base = get_base_livy_payload('')
+    del base['className']
+    base['kind'] = 'spark'
+    base['jars'] = [base.pop('file')]
+
+    return base
+
+
 step_processing = {
     'load_parquet_partition': get_load_parquet_partition_request,
     'load_redshift_partition': get_load_redshift_partition_request,
@@ -169,15 +248,112 @@ step_processing = {
 }
 
 
+livy_client = None
+
+def get_livy_client():
+    """
+    Livy client for the EMR master, shared by the whole container
+    """
+    global livy_client
+    if livy_client is None:
+        livy_client = LivyClient(env.emr_master_address,
+            connect_timeout=float(os.environ.get('livy_connect_timeout', 5)),
+            read_timeout=float(os.environ.get('livy_read_timeout', 30)),
+            retries=int(os.environ.get('livy_retries', 3)))
+    return livy_client
+
+
+# 'batch' submits every step as its own Livy batch, 'session' runs steps as
+# statements on pooled interactive sessions (falling back to a batch while
+# no session is idle)
+execution_mode = os.environ.get('livy_execution_mode', 'batch')
+
+session_pool = None
+
+def get_session_pool():
+    global session_pool
+    if session_pool is None:
+        session_pool = SessionPool(get_livy_client(), f"{env.project}-steps",
+            get_livy_session_payload(),
+            size=int(os.environ.get('livy_session_pool_size', 2)),
+            max_age=float(os.environ.get('livy_session_max_age', 4 * 3600)))
+    return session_pool
+
+
+def get_optional_int(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+# Admission control is on as soon as one of the YARN limits is set
+admission_limits = {
+    'max_running_apps': get_optional_int('yarn_max_running_apps'),
+    'max_pending_containers': get_optional_int('yarn_max_pending_containers'),
+    'min_available_mb': get_optional_int('yarn_min_available_mb')
+}
+
+admission_controller = None
+
+def admission_enabled():
+    return any(limit is not None for limit in admission_limits.values())
+
+
+def get_cluster_capacity():
+    """
+    Number of Spark applications the cluster can take now, None if it's
+    unlimited or admission control is off
+    """
+    global admission_controller
+    if not admission_enabled():
+        return None
+    if admission_controller is None:
+        admission_controller = AdmissionController(env.emr_master_address,
+            livy_client=get_livy_client(),
+            port=int(os.environ.get('yarn_rm_port', 8088)),
+            **admission_limits)
+    return admission_controller.capacity()
+
+
 def send_job(step, payload):
+    """
+    Submit a step for a partition. Returns the Livy batch, or the statement
+    (with its 'session' id) when it ran on a pooled session
+    """
     body = step_processing[step](payload)
 
-    address = f"http://{env.emr_master_address}:8998/batches"
-    print(address)
-    print(body)
-    response = requests.post(address, json=body, headers={
-        'Content-Type': 'application/json'
-    })
+    # The body carries the JDBC credentials, don't log it
+    print(f"Submitting {step} ({body['className']}) for {payload['country']}")
+
+    if execution_mode == 'session':
+        statement = get_session_pool().run(scala_main_call(body['className'], body['args']))
+        if statement is not None:
+            print(f"Livy session {statement['session']} statement {statement.get('id')}")
+            return statement
+
+    batch = get_livy_client().submit_batch(body)
+    print(f"Livy batch {batch.get('id')} is {batch.get('state')}")
+
+    return batch
+
+
+def send_jobs(jobs):
+    """
+    Submit several (step, payload) jobs at once. Returns, in order, the
+    Livy batch (or statement) or the exception raised for each job
+    """
+    if execution_mode == 'session':
+        get_session_pool().begin_pass()
+        with ThreadPoolExecutor(max_workers=max(len(jobs), 1)) as executor:
+            futures = [executor.submit(send_job, step, payload) for step, payload in jobs]
+        return [future.exception() or future.result() for future in futures]
+
+    bodies = [step_processing[step](payload) for step, payload in jobs]
+    for (step, payload), body in zip(jobs, bodies):
+        print(f"Submitting {step} ({body['className']}) for {payload['country']}")
+
+    batches = get_livy_client().submit_batches(bodies)
+    for batch in batches:
+        if not isinstance(batch, Exception):
+            print(f"Livy batch {batch.get('id')} is {batch.get('state')}")
 
-    print(response.json())
-    response.raise_for_status()
+    return batches
@@ -0,0 +1,144 @@
+import boto3
+import json
+
+from datetime import datetime, timedelta
+
+class FanoutJoin():
+    """
+    Joins the invocations an archive was fanned out to, so that its
+    partition is queued once every group of members landed, by the last
+    group to finish. The state of every fan-out is kept in the lock table
+    (as 'unzip:fanout:{id}' items): the number of groups, the groups that
+    arrived, and what they ingested.
+
+    Groups arrive with a conditional write, so a group whose invocation is
+    retried only counts once. A join is closed once, either by the last
+    group or, when a group never arrives (e.g. killed by the function
+    timeout), by the reconciler sweeping stale joins. Whoever closes it
+    queues the partition.
+    """
+
+    prefix = 'unzip:fanout:'
+
+    def __init__(self, tableName):
+        self.tableName = tableName
+        self.db = boto3.client('dynamodb')
+
+    def key(self, join_id):
+        return {
+            'name': {
+                'S': f"{self.prefix}{join_id}"
+            }
+        }
+
+    def start(self, join_id, groups, task):
+        """
+        Record a fan-out to `groups` invocations of a (serialized) task,
+        before invoking them
+        """
+        now = datetime.utcnow()
+        self.db.put_item(TableName=self.tableName, Item={
+            **self.key(join_id),
+            'groups': {
+                'N': str(groups)
+            },
+            'task': {
+                'S': task
+            },
+            'startedAt': {
+                'N': str(now.timestamp())
+            },
+            'ttl': {
+                'N': str((now + timedelta(days=2)).timestamp())
+            }
+        })
+
+    def arrive(self, join_id, group, line_count=0, interfaces=(), converted=()):
+        """
+        Record that a group is done, with the lines and interfaces it
+        ingested and the interfaces it converted to Parquet. Returns None
+        unless this was the last group and it closed the join, in which
+        case it returns the totals of all groups as a dict
+        """
+        update = 'ADD arrived :group, lineCount :lines'
+        values = {
+            ':group': {'SS': [str(group)]},
+            ':groupName': {'S': str(group)},
+            ':lines': {'N': str(line_count)}
+        }
+        # String sets can't be empty
+        if interfaces:
+            update += ', interfaces :interfaces'
+            values[':interfaces'] = {'SS': sorted(interfaces)}
+        if converted:
+            update += ', converted :converted'
+            values[':converted'] = {'SS': sorted(converted)}
+
+        try:
+            state = self.db.update_item(TableName=self.tableName, Key=self.key(join_id),
+                UpdateExpression=update,
+                ConditionExpression='attribute_exists(#name) AND NOT contains(arrived, :groupName) '
+                    'AND attribute_not_exists(closedAt)',
+                ExpressionAttributeNames={'#name': 'name'},
+                ExpressionAttributeValues=values,
+                ReturnValues='ALL_NEW')['Attributes']
+        except self.db.exceptions.ConditionalCheckFailedException:
+            print(f"Group {group} of {join_id} already arrived, or the join was closed without it")
+            return None
+
+        if len(state['arrived']['SS']) < int(state['groups']['N']):
+            return None
+
+        return self.close(join_id)
+
+    def close(self, join_id):
+        """
+        Close a join, returns its totals as a dict (None if it was already
+        closed): the lines, interfaces ingested and converted, the task
+        and the groups that never arrived
+        """
+        try:
+            state = self.db.update_item(TableName=self.tableName, Key=self.key(join_id),
+                UpdateExpression='SET closedAt = :now',
+                ConditionExpression='attribute_exists(#name) AND attribute_not_exists(closedAt)',
+                ExpressionAttributeNames={'#name': 'name'},
+                ExpressionAttributeValues={':now': {'N': str(datetime.utcnow().timestamp())}},
+                ReturnValues='ALL_NEW')['Attributes']
+        except self.db.exceptions.ConditionalCheckFailedException:
+            return None
+
+        arrived = set(state.get('arrived', {}).get('SS', []))
+        return {
+            'line_count': int(state.get('lineCount', {}).get('N', 0)),
+            'interfaces': sorted(state.get('interfaces', {}).get('SS', [])),
+            'converted': sorted(state.get('converted', {}).get('SS', [])),
+            'task': json.loads(state['task']['S']) if 'task' in state else None,
+            'missing': [group for group in range(int(state['groups']['N']))
+                if str(group) not in arrived]
+        }
+
+    def stale(self, timeout):
+        """
+        Return the ids of the joins started more than `timeout` seconds
+        ago that are still open
+        """
+        join_ids = []
+        params = {
+            'TableName': self.tableName,
+            'ProjectionExpression': '#name',
+            'FilterExpression': 'begins_with(#name, :prefix) AND startedAt < :cutoff '
+                'AND attribute_not_exists(closedAt)',
+            'ExpressionAttributeNames': {'#name': 'name'},
+            'ExpressionAttributeValues': {
+                ':prefix': {'S': self.prefix},
+                ':cutoff': {'N': str(datetime.utcnow().timestamp() - timeout)}
+            },
+            'ConsistentRead': True
+        }
+
+        while True:
+            response = self.db.scan(**params)
+            join_ids.extend(item['name']['S'][len(self.prefix):] for item in response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                return join_ids
+            params['ExclusiveStartKey'] = response['LastEvaluatedKey']
@@ -1,64 +1,513 @@
+import admission
 import boto3
 import os
 import dlutils
 import json
 import uuid
+import livy
+import requests
+import stepdag
 
+from datetime import datetime
+from fanoutjoin import FanoutJoin
+from jobtracker import JobTracker
 from lockutils import LockerClient
 from pyutils import EnvObject
+from stepdag import StepDag
 
 sns = boto3.client('sns')
 sqs = boto3.resource('sqs')
 fnc = boto3.client('lambda')
 
 env = EnvObject()
-map_steps = dlutils.map_steps
+# Steps run for every partition, the linear map_steps chain by default
+dag_spec = stepdag.load_spec(os.environ.get('emr_step_dag'),
+    dlutils.map_steps, dlutils.step_processing)
+
+# Countries processed at once, at most, each holding a slot of running_pool
+max_dispatch = int(os.environ.get('emr_max_dispatch', 10))
+# Receive calls made by a dispatch pass, at most
+max_receive_rounds = 12
+# Partitions ready for the same step coalesced into one Spark submission,
+# at most (1 submits every partition on its own)
+max_coalesce = int(os.environ.get('emr_coalesce_partitions', 1))
+# Seconds a finished job may go without calling back before it's considered lost
+callback_grace = float(os.environ.get('emr_callback_grace', 600))
+# Seconds before the first retry of a failed step, doubling with every
+# attempt up to retry_backoff_max (0 retries right away). Delayed retries
+# are submitted by the scheduled reconciler
+retry_backoff = float(os.environ.get('emr_retry_backoff', 0))
+retry_backoff_max = float(os.environ.get('emr_retry_backoff_max', 1800))
+# Seconds before a job that found the cluster full is tried again, doubling
+# every time it's turned away
+admission_backoff = float(os.environ.get('emr_admission_backoff', 60))
+# Seconds the reconciler has to submit a deferred job it took, after which
+# the job is due again (longer than the function timeout)
+deferred_lease = float(os.environ.get('emr_deferred_lease', 900))
+# Seconds an archive fanned out at ingestion may wait for its groups, after
+# which the groups that didn't arrive are given up on (longer than the
+# unzip function timeout times its async retries)
+fanout_timeout = float(os.environ.get('emr_fanout_timeout', 3600))
+
+# Lock held by a country while its partition goes through the steps
+lock_prefix = 'emrsteps:main:'
+# Item holding the countries being processed, max_dispatch at most
+running_pool = 'emrsteps:running'
+
+def chunks(items, size=10):
+    """
+    Split a list for SQS batch calls, which take at most 10 entries
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def slot_member(task):
+    return f"{task['country']}:{task['execution_id']}"
+
+def release_country(locker, task):
+    """
+    Free the slot of a country that is done with its partition and unlock
+    it, in that order so that a slot is never freed for the next execution.
+    The lock is only released if the execution still holds it
+    """
+    locker.give_slot(running_pool, slot_member(task))
+    locker.release_lock(f"{lock_prefix}{task['country']}", owner=str(task['execution_id']))
+
+def free_stale_slots(locker):
+    """
+    Free the slots of countries whose lock is gone without them (expired,
+    or released by an invocation that died before freeing the slot)
+    """
+    for member in locker.slots_taken(running_pool):
+        country, execution_id = member.split(':', 1)
+        if not locker.is_held(f"{lock_prefix}{country}", owner=execution_id):
+            print(f"Freeing the stale slot of {member}")
+            locker.give_slot(running_pool, member)
+
+def get_dag():
+    return StepDag(env.lock_table, dag_spec, dlutils.interfaces, dlutils.map_steps,
+        dlutils.converted_step)
+
+def restart_cycle():
+    """
+    Invoke the dispatcher to start whatever country is pending
+    """
+    fnc.invoke(FunctionName=env.function_name,
+        InvocationType='Event',
+        Payload=json.dumps({
+            'Step': 'initial',
+            'Sentinel': str(uuid.uuid4())
+        }).encode())
+
+def submit_jobs(jobs, capacity=None, deferrals=None):
+    """
+    Submit (step, task) jobs, coalescing partitions ready for the same step.
+    Submissions beyond the cluster `capacity` (None for unlimited) are
+    deferred for the reconciler, backing off by the number of times each
+    country was already turned away (`deferrals`). Returns (step, payload,
+    batch or exception) for every submission, with None for deferred ones
+    """
+    payloads = []
+    for step in sorted(set(step for step, _ in jobs)):
+        tasks = [task for job_step, task in jobs if job_step == step]
+        payloads.extend((step, payload)
+            for payload in dlutils.coalesce_tasks(tasks, max_coalesce))
+
+    if not payloads:
+        return []
+
+    tracker = JobTracker(env.lock_table)
+    deferrals = deferrals or {}
+    deferred = []
+    if capacity is not None and len(payloads) > capacity:
+        payloads, deferred = payloads[:capacity], payloads[capacity:]
+        for step, payload in deferred:
+            for task in dlutils.get_payload_tasks(payload):
+                count = deferrals.get(task['country'], 0)
+                delay = admission.backoff_delay(count, admission_backoff, retry_backoff_max)
+                print(f"Cluster is full, deferring {step} for {task['country']} by {int(delay)}s")
+                tracker.defer(step, task, delay, count + 1)
+
+    results = dlutils.send_jobs(payloads) if payloads else []
+
+    # Track submitted jobs, so the reconciler can tell if they get lost
+    for (step, payload), result in zip(payloads, results):
+        if isinstance(result, Exception):
+            continue
+        for task in dlutils.get_payload_tasks(payload):
+            try:
+                tracker.track(step, task, result)
+            except Exception as e:
+                print(f"Failed to track {step} for {task['country']}: {e}")
+
+    return [(step, payload, result) for (step, payload), result in zip(payloads, results)] + \
+        [(step, payload, None) for step, payload in deferred]
+
+def dispatch_pending(queue, locker):
+    """
+    Start the step chain for every country with queued work that isn't
+    already being processed, as long as fewer than `max_dispatch`
+    countries are being processed and as many as the cluster can take.
+    Locks are taken for all candidate countries at once, then a slot of
+    the running pool for each, and their jobs are submitted in bulk;
+    everything else goes back to the queue.
+    """
+    running = len(locker.slots_taken(running_pool))
+    if running >= max_dispatch:
+        # Whoever finishes a country restarts the cycle
+        print(f"{running} countries already being processed, not dispatching")
+        return []
+
+    capacity = dlutils.get_cluster_capacity()
+    limit = max_dispatch - running
+    if capacity is not None:
+        limit = min(limit, capacity * max(max_coalesce, 1))
+    if limit == 0:
+        # Messages stay queued, the reconciler dispatches again later
+        print('Cluster is full, not dispatching')
+        return []
+
+    started = {}
+    skipped = []
+    rounds = 0
+    full = False
+
+    while len(started) < limit and rounds < max_receive_rounds and not full:
+        messages = queue.receive_messages(
+            AttributeNames=['MessageGroupId'],
+            MaxNumberOfMessages=10)
+        rounds += 1
+
+        # Exit early if no messages in queue
+        if not messages:
+            break
+
+        # One message per country and pass, later ones wait for the next pass
+        candidates = {}
+        for message in messages:
+            country = message.attributes['MessageGroupId']
+            if country in started or country in candidates \
+                    or len(started) + len(candidates) >= limit:
+                skipped.append(message)
+            else:
+                candidates[country] = message
+
+        # Locks are held by the execution, so that a late callback of an
+        # earlier one can't release them
+        tasks = {country: json.loads(message.body) for country, message in candidates.items()}
+        acquired = locker.try_acquire_many(
+            (f"{lock_prefix}{country}" for country in candidates),
+            owners={f"{lock_prefix}{country}": str(task['execution_id'])
+                for country, task in tasks.items()})
+        for country, message in candidates.items():
+            if f"{lock_prefix}{country}" not in acquired:
+                # Country is being processed
+                skipped.append(message)
+            elif not full and locker.take_slot(running_pool, slot_member(tasks[country]), max_dispatch):
+                started[country] = message
+            else:
+                # Dispatchers running at the same time took the last slots
+                full = True
+                locker.release_lock(f"{lock_prefix}{country}", owner=str(tasks[country]['execution_id']))
+                skipped.append(message)
+
+    # We got the locks, start processing from the roots of the DAG
+    dag = get_dag()
+    errors = []
+    failed = set()
+    jobs = []
+    finished = []
+    for country, message in started.items():
+        started_jobs = dag.start(json.loads(message.body))
+        if not started_jobs:
+            # Everything was done at ingestion
+            finished.append(country)
+        jobs.extend(started_jobs)
+
+    # Deferred jobs keep the lock, the reconciler submits them
+    for step, payload, batch in submit_jobs(jobs, capacity):
+        if not isinstance(batch, Exception):
+            continue
+        countries = [task['country'] for task in dlutils.get_payload_tasks(payload)]
+        print(f"Failed to start {step} for {', '.join(countries)}: {batch}")
+        errors.append(batch)
+        failed.update(countries)
+
+    processed = [message for country, message in started.items() if country not in failed]
+    for country in finished:
+        release_country(locker, json.loads(started[country].body))
+    for country in failed:
+        release_country(locker, json.loads(started[country].body))
+        skipped.append(started[country])
+
+    for entries in chunks(processed):
+        queue.delete_messages(Entries=[
+            {'Id': str(i), 'ReceiptHandle': message.receipt_handle}
+            for i, message in enumerate(entries)])
+
+    # Return the rest to the queue, once the whole pass is done so that
+    # the same messages aren't received again meanwhile
+    for entries in chunks(skipped):
+        queue.change_message_visibility_batch(Entries=[
+            {'Id': str(i), 'ReceiptHandle': message.receipt_handle, 'VisibilityTimeout': 0}
+            for i, message in enumerate(entries)])
+
+    if errors:
+        raise errors[0]
+
+    return list(started)
 
 def continue_step_chain(event):
-    step = event['Step']
-    task = event['Task']
-    status = event['Status']
+    # Jobs call back with their DAG node, the step plus its interface
+    # when the step is fanned out
+    step, interface = stepdag.parse_node(event['Step'])
 
-    next_attempt = task['attempt'] + 1
-    next_step = map_steps[step]
-    locker = LockerClient(env.lock_table)
-    
-    # Unlock country, restart cycle
-    if next_step == 'final' and status == 'COMPLETED':
-        locker.release_lock(f"emrsteps:main:{task['country']}")
-        fnc.invoke(FunctionName=env.function_name,
-            InvocationType='Event',
-            Payload=json.dumps({
-                'Step': 'initial',
-                'Sentinel': str(uuid.uuid4())
-            }).encode())
-    # Otherwise continue chain
+    # Coalesced jobs report every partition on its own
+    if 'Partitions' in event:
+        reports = [(report['Task'], report['Status']) for report in event['Partitions']]
     else:
-        print('Process next Step')
+        reports = [(event['Task'], event['Status'])]
 
-        # Job succesful, next step in the chain
+    locker = LockerClient(env.lock_table)
+    tracker = JobTracker(env.lock_table)
+    dag = get_dag()
+    jobs = []
+    claimed = []
+    restart = False
+
+    for task, status in reports:
+        task = stepdag.with_interface(task, interface)
+
+        # Ignore callbacks for jobs that were superseded or already reconciled
+        submitted = tracker.untrack(step, task, reconciled=event.get('Reconciled', False))
+        if submitted is None:
+            print(f"Ignoring stale callback for {event['Step']} on {task['country']}")
+            continue
+        # Keep fields of the task that the job doesn't report back
+        task = dict(submitted, **task)
+
+        next_attempt = task['attempt'] + 1
+
+        # Job succesful, start the nodes that became ready. Whoever
+        # completes the last node unlocks the country and restarts the cycle
         if status == 'COMPLETED':
-            dlutils.send_job(next_step, task)
+            print('Process next Step')
+            ready, finished = dag.complete(step, task)
+            claimed.extend(ready)
+            if finished:
+                release_country(locker, task)
+                restart = True
+        # Another branch failed for good, this one is only settled. The
+        # last branch to end unlocks the country
+        elif dag.is_failed(task):
+            print(f"Execution {task['execution_id']} for {task['country']} failed, "
+                f"not retrying {event['Step']}")
+            if dag.settle(step, task):
+                release_country(locker, task)
+                restart = True
         # Job failed, can be retried
         elif status == 'FAILED' and next_attempt <= 5:
             task['attempt'] = next_attempt
             print('Invoke: ' + step)
-            dlutils.send_job(step, task)
-        # Job failed, can't be retried, go to dead letter queue
+            if retry_backoff > 0:
+                delay = admission.backoff_delay(next_attempt - 1, retry_backoff, retry_backoff_max)
+                print(f"Retrying {step} for {task['country']} in {int(delay)}s")
+                tracker.defer(step, task, delay)
+            else:
+                jobs.append((step, task))
+        # Job failed, can't be retried, go to dead letter queue. The country
+        # is unlocked once the other branches still running ended
         else:
-            queue_name = dlutils.get_queue_name(env.sqs_dead_prefix,
-                env.env, env.project, fifo=False)
-            queue = sqs.get_queue_by_name(QueueName=queue_name)
-            queue.send_message(MessageBody=json.dumps(task))
+            first, finished = dag.fail(step, task)
+            if first:
+                queue_name = dlutils.get_queue_name(env.sqs_dead_prefix,
+                    env.env, env.project, fifo=False)
+                queue = sqs.get_queue_by_name(QueueName=queue_name)
+                queue.send_message(MessageBody=json.dumps(task))
 
             # Restart cycle
-            locker.release_lock(f"emrsteps:main:{task['country']}")
-            fnc.invoke(FunctionName=env.function_name,
-                InvocationType='Event',
-                Payload=json.dumps({
-                    'Step': 'initial',
-                    'Sentinel': str(uuid.uuid4())
-                }).encode())
+            if finished:
+                release_country(locker, task)
+                restart = True
+
+    jobs.extend(claimed)
+    capacity = dlutils.get_cluster_capacity() if jobs else None
+    for next_step, payload, batch in submit_jobs(jobs, capacity):
+        if not isinstance(batch, Exception):
+            continue
+        # A retried invocation is dropped as a repeat and the callback's job
+        # is no longer tracked, so the reconciler submits them later
+        for task in dlutils.get_payload_tasks(payload):
+            print(f"Failed to submit {next_step} for {task['country']}, deferring: {batch}")
+            tracker.defer(next_step, task,
+                admission.backoff_delay(0, admission_backoff, retry_backoff_max))
+
+    if restart:
+        restart_cycle()
+
+def get_job_status(client, job, cache):
+    """
+    Classify a tracked job from its Livy state as 'running', 'failed' or
+    'finished'. Jobs Livy no longer knows about count as finished, the
+    callback grace period decides whether they got lost
+    """
+    if 'batchId' in job:
+        key = ('batch', job['batchId'])
+        if key not in cache:
+            try:
+                cache[key] = client.get_batch_state(job['batchId'])
+            except requests.exceptions.HTTPError as e:
+                if getattr(e.response, 'status_code', None) != 404:
+                    raise
+                cache[key] = None
+        state = cache[key]
+        if state in livy.BATCH_FAILED_STATES:
+            return 'failed'
+        if state is None or state in livy.BATCH_FINISHED_STATES:
+            return 'finished'
+        return 'running'
+
+    key = ('statement', job['sessionId'], job['statementId'])
+    if key not in cache:
+        try:
+            cache[key] = client.get_statement(job['sessionId'], job['statementId'])
+        except requests.exceptions.HTTPError as e:
+            if getattr(e.response, 'status_code', None) != 404:
+                raise
+            cache[key] = None
+    statement = cache[key]
+    if statement is None:
+        return 'finished'
+    if statement['state'] in livy.STATEMENT_FAILED_STATES:
+        return 'failed'
+    if statement['state'] == 'available':
+        output = statement.get('output') or {}
+        return 'failed' if output.get('status') == 'error' else 'finished'
+    return 'running'
+
+def submit_deferred(tracker, jobs):
+    """
+    Submit deferred jobs that are due, as far as the cluster takes them.
+    Jobs that can't be submitted are deferred again. Jobs of executions
+    that failed meanwhile are dropped and settled instead
+    """
+    claimed = [job for job in jobs if tracker.claim_deferred(job, deferred_lease)]
+    if not claimed:
+        return
+
+    dag = get_dag()
+    failed = [job for job in claimed if dag.is_failed(job['task'])]
+    if failed:
+        locker = LockerClient(env.lock_table)
+        for job in failed:
+            print(f"Execution {job['task']['execution_id']} for {job['task']['country']} failed, "
+                f"dropping {job['step']}")
+            tracker.untrack(job['step'], job['task'])
+            if dag.settle(job['step'], job['task']):
+                release_country(locker, job['task'])
+                restart_cycle()
+        claimed = [job for job in claimed if job not in failed]
+        if not claimed:
+            return
+
+    deferrals = {job['task']['country']: job['deferrals'] for job in claimed}
+    results = submit_jobs([(job['step'], job['task']) for job in claimed],
+        dlutils.get_cluster_capacity(), deferrals)
+
+    for step, payload, batch in results:
+        if not isinstance(batch, Exception):
+            continue
+        for task in dlutils.get_payload_tasks(payload):
+            count = deferrals[task['country']]
+            print(f"Failed to submit {step} for {task['country']}: {batch}")
+            tracker.defer(step, task,
+                admission.backoff_delay(count, admission_backoff, retry_backoff_max), count + 1)
+
+def sweep_fanouts():
+    """
+    Close the fan-outs of archives whose groups didn't all arrive in time
+    (a group killed by the function timeout never does), reporting the
+    groups missing and queueing the partition with what the others
+    ingested. Returns whether any partition was queued
+    """
+    join = FanoutJoin(env.lock_table)
+    queued = False
+
+    for join_id in join.stale(fanout_timeout):
+        outcome = join.close(join_id)
+        if not outcome:
+            continue
+
+        print(f"Fan-out {join_id} timed out, groups {outcome['missing']} never arrived")
+        sns.publish(TopicArn=env.sns_topic,
+            Message=f"Ingestion {join_id}: groups {outcome['missing']} never arrived, "
+                f"partition queued with {outcome['interfaces']}")
+        if not outcome['interfaces'] or not outcome['task']:
+            continue
+
+        task = dlutils.partition_task(outcome['task'], outcome['interfaces'], outcome['converted'])
+        queue_name = dlutils.get_queue_name(env.sqs_prefix, env.env, env.project)
+        queue = sqs.get_queue_by_name(QueueName=queue_name)
+        queue.send_message(MessageBody=json.dumps(task), MessageGroupId=task['country'])
+        queued = True
+
+    return queued
+
+def reconcile(event, context):
+    """
+    Scheduled entry point: poll Livy for every tracked job and turn jobs
+    that died, or finished without calling back, into FAILED callbacks,
+    so their retry path and lock release run right away. Deferred jobs
+    that are due get submitted and stale slots of the running pool are
+    freed. Fan-outs whose groups never arrived are swept. The dispatcher
+    is started again for partitions swept, and with admission control on
+    for countries waiting on capacity
+    """
+    print('Reconcile: ' + str(event))
+    tracker = JobTracker(env.lock_table)
+    client = dlutils.get_livy_client()
+    cache = {}
+    due = []
+    now = datetime.utcnow().timestamp()
+
+    for job in tracker.pending():
+        if 'deferredUntil' in job:
+            if job['deferredUntil'] <= now:
+                due.append(job)
+            continue
+
+        # Livy failing for one job shouldn't keep the others from being reconciled
+        try:
+            status = get_job_status(client, job, cache)
+        except Exception as e:
+            print(f"Failed to get the state of {job['step']} on {job['task']['country']}: {e}")
+            continue
+        if status == 'running':
+            continue
+        if status == 'finished':
+            finished_at = job['finishedAt'] or tracker.mark_finished(job)
+            if now - finished_at < callback_grace:
+                continue
+
+        if not tracker.claim(job):
+            continue
+
+        print(f"Job for {job['step']} on {job['task']['country']} was lost ({status})")
+        fnc.invoke(FunctionName=env.function_name,
+            InvocationType='Event',
+            Payload=json.dumps({
+                'Step': stepdag.node_id(job['step'], job['task']),
+                'Task': job['task'],
+                'Status': 'FAILED',
+                'Reconciled': True,
+                'Sentinel': str(uuid.uuid4())
+            }).encode())
+
+    submit_deferred(tracker, due)
+    free_stale_slots(LockerClient(env.lock_table))
+    swept = sweep_fanouts()
+
+    if swept or dlutils.admission_enabled():
+        restart_cycle()
 
 def lambda_handler(event, context):
     print('Start: ' + str(event))
@@ -86,37 +535,7 @@ def lambda_handler(event, context):
         else:
             queue_name = dlutils.get_queue_name(env.sqs_prefix, env.env, env.project)
             queue = sqs.get_queue_by_name(QueueName=queue_name)
-            attempts = 0
-
-            # Try for each country, at most
-            while attempts < 12:
-                messages = queue.receive_messages(
-                    AttributeNames=['MessageGroupId'],
-                    MaxNumberOfMessages=1)
-                
-                # Exit early if no messages in queue
-                if not messages:
-                    return
-                
-                message = messages[0]
-                country = message.attributes['MessageGroupId']
-
-                # Check if country is being processed
-                if not locker.get_lock(f"emrsteps:main:{country}"):
-                    # return message to queue
-                    message.change_visibility(VisibilityTimeout=0)
-                    # try again
-                    attempts += 1
-                    continue
-
-                # We got the lock, start processing
-                payload = json.loads(message.body)
-                next_step = map_steps['initial']
-                dlutils.send_job(next_step, payload)
-                message.delete()
-
-                # We can quit now
-                return
+            dispatch_pending(queue, locker)
     except Exception as e:
         sns.publish(TopicArn=env.sns_topic,
             Message=f"Error executing Lambda {env.function_name}.")
@@ -3,55 +3,191 @@ import requests
 import logging
 import json
 import os
+import random
+import time
+from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
 from requests_aws4auth import AWS4Auth
 
 # Setup endpoints
 ES_ENDPOINT = os.environ['es_endpoint']
 ES_DOMAIN = os.environ['domain_name']
-url = f'https://{ES_ENDPOINT}/{ES_DOMAIN}/{ES_DOMAIN}'
+es_url = f'https://{ES_ENDPOINT}'
+bulk_url = f'{es_url}/_bulk'
+
+# Events go to daily indices, searched through an alias
+ES_ALIAS = os.environ.get('es_alias', f'{ES_DOMAIN}-events')
+INDEX_DATE_FORMAT = '%Y.%m.%d'
+# Days of events kept, whole indices are dropped after that
+RETENTION_DAYS = int(os.environ.get('retention_days', 14))
+
+# Bulk requests retried for throttled or failed items, at most
+BULK_RETRIES = int(os.environ.get('es_bulk_retries', 3))
+# Item statuses worth retrying: throttling and server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Connections are reused across records and invocations
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
 
 # Setup credentials
 ES_REGION = os.environ['region']
+credentials = boto3.Session().get_credentials()
+auth = None
+auth_key = None
+
 def setup_credentials():
-    credentials = boto3.Session().get_credentials()
-    return AWS4Auth(credentials.access_key, credentials.secret_key,
-        ES_REGION, 'es', session_token=credentials.token)
+    """
+    Signer for ES requests, rebuilt only when the credentials changed.
+    Refreshable credentials renew themselves shortly before expiring
+    """
+    global auth, auth_key
+    frozen = credentials.get_frozen_credentials()
+    if auth is None or auth_key != (frozen.access_key, frozen.token):
+        auth = AWS4Auth(frozen.access_key, frozen.secret_key,
+            ES_REGION, 'es', session_token=frozen.token)
+        auth_key = (frozen.access_key, frozen.token)
+    return auth
 
 # Setup headers
 headers = { "Content-Type": "application/json" }
+bulk_headers = { "Content-Type": "application/x-ndjson" }
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
-def lambda_handler(event, context):
-    LOGGER.info("Received event, handling for ES")
+class BulkError(Exception):
+    pass
 
-    for record in event['Records']:
-        payload = json.loads(record['Sns']['Message'])
-        
-        LOGGER.info("Adding ingestion log entry")
-        response = requests.post(url, timeout=(5, 5),
-            auth=setup_credentials(), json=payload, headers=headers)
-        if not response.ok:
-            LOGGER.error("Error sending data to ES (%s): %s",
-                str(response.status_code), str(response.json()))
+template_ready = False
 
-def purge(event, context):
-    LOGGER.info("Received purge event, ignoring payload")
+def ensure_template():
+    """
+    Install the template of the daily indices, once per container
+    """
+    global template_ready
+    if template_ready:
+        return
 
-    query_payload = {
-        "query": {
-            "range" : {
-                "event_timestamp" : {
-                    "lt" : "now-14d/d"
+    template = {
+        "index_patterns": [f"{ES_DOMAIN}-*"],
+        "settings": {
+            "number_of_shards": int(os.environ.get('es_index_shards', 1))
+        },
+        "aliases": {
+            ES_ALIAS: {}
+        },
+        "mappings": {
+            ES_DOMAIN: {
+                "properties": {
+                    "timestamp": {"type": "date"},
+                    "event_timestamp": {"type": "date"}
                 }
             }
         }
     }
+    response = session.put(f'{es_url}/_template/{ES_DOMAIN}', timeout=(5, 30),
+        auth=setup_credentials(), json=template, headers=headers)
+    if not response.ok:
+        raise BulkError(f"Error installing ES index template ({response.status_code}): {response.text}")
+    template_ready = True
+
+def index_name(day):
+    return f"{ES_DOMAIN}-{day.strftime(INDEX_DATE_FORMAT)}"
+
+def bulk_body(documents):
+    """
+    NDJSON body indexing (id, index, document) triples. SNS message ids are
+    used as document ids, so redelivered messages overwrite instead of
+    duplicating
+    """
+    lines = []
+    for doc_id, index, document in documents:
+        lines.append(json.dumps({"index": {"_index": index, "_type": ES_DOMAIN, "_id": doc_id}}))
+        lines.append(json.dumps(document))
+    return '\n'.join(lines) + '\n'
+
+def send_bulk(documents):
+    """
+    Index documents with a single _bulk request, returns the documents
+    that should be retried along with the errors that were dropped
+    """
+    response = session.post(bulk_url, timeout=(5, 30), auth=setup_credentials(),
+        data=bulk_body(documents).encode('utf-8'), headers=bulk_headers)
+    if response.status_code in RETRY_STATUSES:
+        LOGGER.warning("ES bulk request failed (%s), retrying", str(response.status_code))
+        return documents, []
+    if not response.ok:
+        raise BulkError(f"Error sending data to ES ({response.status_code}): {response.text}")
+
+    result = response.json()
+    if not result.get('errors'):
+        return [], []
+
+    retry = []
+    dropped = []
+    for document, item in zip(documents, result['items']):
+        outcome = item['index']
+        if outcome['status'] in RETRY_STATUSES:
+            retry.append(document)
+        elif outcome['status'] >= 300:
+            dropped.append((document[0], outcome['status'], outcome.get('error')))
+    return retry, dropped
+
+def lambda_handler(event, context):
+    LOGGER.info("Received event, handling for ES")
+
+    ensure_template()
+
+    # Events are indexed by the day they were published, so that a
+    # redelivered message lands in the same index
+    documents = [(record['Sns']['MessageId'],
+            index_name(datetime.strptime(record['Sns']['Timestamp'][:10], '%Y-%m-%d')),
+            json.loads(record['Sns']['Message']))
+        for record in event['Records']]
+
+    LOGGER.info("Adding %d ingestion log entries", len(documents))
+    for attempt in range(BULK_RETRIES + 1):
+        if attempt:
+            time.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+
+        documents, dropped = send_bulk(documents)
+        for doc_id, status, error in dropped:
+            LOGGER.error("Error sending %s to ES (%s): %s", doc_id, str(status), str(error))
+        if not documents:
+            return
+
+    # Raise so that SNS redelivers, ids make it safe to index again
+    raise BulkError(f"{len(documents)} entries still failing after {BULK_RETRIES} retries")
+
+def purge(event, context):
+    LOGGER.info("Received purge event, ignoring payload")
+
+    response = session.get(f'{es_url}/_cat/indices/{ES_DOMAIN}-*', timeout=(5, 30),
+        auth=setup_credentials(), params={"format": "json", "h": "index"})
+    if not response.ok:
+        LOGGER.error("Error listing ES indices (%s): %s",
+            str(response.status_code), response.text)
+        return
+
+    oldest = index_name(datetime.utcnow() - timedelta(days=RETENTION_DAYS))
+    expired = []
+    for entry in response.json():
+        try:
+            datetime.strptime(entry['index'][len(ES_DOMAIN) + 1:], INDEX_DATE_FORMAT)
+        except ValueError:
+            continue
+        # Zero padded dates compare like the days they stand for
+        if entry['index'] < oldest:
+            expired.append(entry['index'])
+
+    if not expired:
+        return
 
-    # delete_by_query can be slow, be prepared for it
-    response = requests.post(url + '/_delete_by_query', timeout=(5, 60),
-        auth=setup_credentials(), json=query_payload, headers=headers)
+    # Dropping whole indices is cheap, unlike deleting documents
+    LOGGER.info("Deleting expired indices %s", ', '.join(sorted(expired)))
+    response = session.delete(f"{es_url}/{','.join(sorted(expired))}", timeout=(5, 60),
+        auth=setup_credentials(), headers=headers)
     if not response.ok:
         LOGGER.error("Error purging old data from ES (%s): %s",
-            str(response.status_code), str(response.json()))
+            str(response.status_code), response.text)
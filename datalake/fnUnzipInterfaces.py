@@ -1,17 +1,29 @@
 import zipfile
 import boto3
-import io
 import datetime
 import os
 import random
+import time
 import json
 import dlutils
 import glueutils
 import json
 import uuid
+import codecs
+import compression
+import contextlib
+import itertools
+import monitoring
+import parquetutils
+import s3utils
+import s3zip
+import textutils
 
+from concurrent.futures import ThreadPoolExecutor
+from fanoutjoin import FanoutJoin
+from lockutils import LockerClient
 from monitoring import Task
-from traceback import format_exc
+from traceback import format_exc, format_exception
 from pyutils import EnvObject
 
 sns = boto3.client('sns')
@@ -27,21 +39,374 @@ level_country = 3
 
 interfaces = dlutils.interfaces
 
-def lambda_handler(event, context):
-    print('Start: ' + str(event))
-    if isinstance(event, str):
-        event = json.loads(event)
-    
-    now = datetime.datetime.utcnow()
-    
+# Zip members are streamed to S3 in chunks of this size, which also bounds
+# the multipart part size. Archives larger than the spool size go to /tmp
+chunk_size = int(os.environ.get('unzip_chunk_size', s3utils.DEFAULT_CHUNK_SIZE))
+spool_size = int(os.environ.get('unzip_spool_size', s3utils.DEFAULT_SPOOL_SIZE))
+
+# When set, archives are read with ranged GETs ('ranged') instead of being
+# downloaded whole ('spooled'), and their interfaces are split in groups of
+# `unzip_fanout_group_size` members, each ingested by its own invocation
+reader_mode = os.environ.get('unzip_reader', 'spooled')
+fanout_group_size = int(os.environ.get('unzip_fanout_group_size', 0))
+
+# Number of interfaces of one archive ingested concurrently
+workers = int(os.environ.get('unzip_workers', 1))
+
+# Members up to this many bytes (uncompressed) are also converted to Parquet
+# here, so load_parquet_partition can skip them. 0 turns it off, as does a
+# missing pyarrow
+parquet_max_size = int(os.environ.get('unzip_parquet_max_size', 0))
+
+# Codec of the text landed in the CSV tables, none by default
+codec = compression.get_codec(os.environ.get('csv_output_codec'))
+codec_level = dlutils.get_optional_int('csv_output_level')
+
+# Members larger than this many (uncompressed) bytes are cut at line breaks
+# into parts of about the same size, each a separate object, so that Spark
+# reads them in parallel even when the codec can't be split. 0 turns it off
+part_size = int(os.environ.get('unzip_part_size', 256 * 1024 * 1024))
+
+# Number of archives of one event (S3 notification or SQS batch)
+# ingested concurrently. Each archive may hold up to `spool_size` in memory,
+# so the function's memory has to be sized for this many of them
+record_workers = int(os.environ.get('unzip_record_workers', 1))
+
+# Archives ingested in the same second would share a partition, each one
+# claims its own in the lock table, trying this many seconds from its
+# execution time on
+partition_prefix = 'unzip:partition:'
+partition_claims = int(os.environ.get('unzip_partition_claims', 60))
+
+# Execution time is handed over to fan-out invocations so that every
+# group lands in the same partition
+time_format = '%Y-%m-%dT%H:%M:%S.%f'
+
+class IngestionError(Exception):
+    """
+    Raised when one or more interfaces of an archive failed to ingest
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__(f"Failed to ingest interfaces: {', '.join(failures)}")
+
+class BatchError(Exception):
+    """
+    Raised when one or more archives of an S3 notification failed to ingest
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+        super().__init__(f"Failed to ingest archives: {', '.join(keys)}")
+
+def get_interface_name(filename, system):
+    """
+    Map a zip member file name to its interface name
+    """
+    name = filename.split('.')[0].lower()
+    if name == 'sap':
+        name = filename.split('.')[1].lower()
+    return name
+
+def get_partition_values(now):
+    """
+    Partition values (year, month, day, secs) for an execution time
+    """
     year = str(now.year)
     month = str(now.month)
     day = str(now.day)
     secs = str(now.hour * 24 * 60 + now.minute * 60 + now.second)
-    key = event['Records'][0]['s3']['object']['key']
-    print(key)
-    print(now)
+    return year, month, day, secs
+
+@contextlib.contextmanager
+def open_archive(key, ranged):
+    """
+    Open an input zip either through ranged GETs or by spooling it locally
+    """
+    if ranged:
+        with monitoring.span('read_directory'):
+            reader = s3zip.S3ZipReader(s3, env.bucket_input, key)
+        with reader as zipf:
+            yield zipf
+    else:
+        with monitoring.span('download') as counts:
+            tf = s3utils.download_spooled(s3, env.bucket_input, key, spool_size)
+            # SpooledTemporaryFile.seek returns None before Python 3.7
+            tf.seek(0, 2)
+            counts['bytes'] = tf.tell()
+            tf.seek(0)
+        with tf, zipfile.ZipFile(tf, mode='r') as zipf:
+            yield zipf
+
+def fan_out(key, members, now, join_id, serialized_task, context):
+    """
+    Invoke this function asynchronously once per group of members, the
+    groups join under `join_id` once they are done
+    """
+    groups = [members[i:i + fanout_group_size]
+        for i in range(0, len(members), fanout_group_size)]
+
+    FanoutJoin(env.lock_table).start(join_id, len(groups), serialized_task)
+    for index, group in enumerate(groups):
+        fnc.invoke(FunctionName=context.function_name,
+            InvocationType='Event',
+            Payload=json.dumps({
+                'Fanout': {
+                    'Key': key,
+                    'Members': group,
+                    'Group': index,
+                    'ExecutionTime': now.strftime(time_format)
+                }
+            }).encode())
+
+    return groups
+
+def stream_member(zipf, file, bucket, stem, converter=None):
+    """
+    Stream a zip member to S3 chunk by chunk, replacing invalid UTF-8
+    sequences on the way (valid chunks are written as they are read),
+    compressing it with the output codec and feeding the text to
+    `converter` if given. Large members are written in balanced parts.
+    Returns the number of lines written and the keys of the parts
+    written under `stem`
+    """
+    sanitizer = textutils.Utf8Sanitizer()
+    # Pieces may end mid sequence, the converter gets whole characters
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    line_count = 0
+    last_byte = b''
+    # Time spent per phase, recorded as spans of the current task
+    read_time = transcode_time = upload_time = 0
+    bytes_read = bytes_written = 0
+
+    with zipf.open(file) as member, \
+            s3utils.PartWriter(s3, bucket, stem, '.txt' + codec.extension, codec,
+                s3utils.balanced_part_size(file.file_size, part_size),
+                chunk_size, codec_level) as writer:
+        chunks = itertools.chain(s3utils.iter_chunks(member, chunk_size), [None])
+        while True:
+            started = time.perf_counter()
+            # The trailing None flushes whatever the sanitizer holds back
+            chunk = next(chunks)
+            read_time += time.perf_counter() - started
+            bytes_read += len(chunk or b'')
+
+            started = time.perf_counter()
+            pieces = sanitizer.finish() if chunk is None else sanitizer.feed(chunk)
+            for data in pieces:
+                # A CRLF may be split across two pieces
+                if last_byte == b'\r' and data[:1] == b'\n':
+                    line_count += 1
+                line_count += data.count(b'\r\n')
+                last_byte = data[-1:]
+                if converter is not None:
+                    converter.feed(text_decoder.decode(data))
+            transcode_time += time.perf_counter() - started
+
+            for data in pieces:
+                started = time.perf_counter()
+                writer.write(data)
+                upload_time += time.perf_counter() - started
+                bytes_written += len(data)
+            if chunk is None:
+                break
+
+        started = time.perf_counter()
+        writer.close()
+        upload_time += time.perf_counter() - started
+
+    task = Task.current()
+    if task is not None:
+        task.record('decompress', read_time, bytes=bytes_read)
+        task.record('transcode', transcode_time, bytes=bytes_read, lines=line_count,
+            rewritten=sanitizer.rewritten)
+        if codec.compressed:
+            task.record('compress', writer.compress_time, bytes=bytes_written)
+        task.record('upload', upload_time - writer.compress_time,
+            bytes=writer.size, parts=len(writer.keys))
+
+    return line_count, writer.keys
+
+def ingest_member(zipf, file, name, system, country, now, convert=False):
+    """
+    Ingest a single interface: ensure its tables exist and land the member
+    in the CSV table, and with `convert` in the Parquet table as well.
+    Returns the line count and output path of the ingested file, the
+    (table name, partition input) pairs to register (none for tables
+    using partition projection), and whether it was converted to Parquet
+    """
+    year, month, day, secs = get_partition_values(now)
+
+    # Create CSV and Parquet tables
+    with monitoring.span('glue_tables'):
+        table_name, table_bucket, table_key = glueutils.create_table(system, name, 'csv', os.environ)
+        parquet_name, parquet_bucket, parquet_key = glueutils.create_table(system, name, 'parquet', os.environ)
+
+    partition = 'pt_country=' + country + \
+               '/pt_year=' + year + \
+               '/pt_month=' + month + \
+               '/pt_day=' + day + \
+               '/pt_secs=' + secs
+
+    converter = None
+    if convert:
+        columns = glueutils.registry.get(system, name, os.environ)['columns']
+        converter = parquetutils.TextToParquet([column['Name'] for column in columns])
+
+    stem = f"{table_key}/{partition}/{name}{str(int(now.timestamp()))}"
+    line_count, keys = stream_member(zipf, file, table_bucket, stem, converter)
+    Task.current().count(line_count=line_count)
+
+    outputs = [(table_name, table_bucket, table_key)]
+    if converter is not None:
+        with monitoring.span('parquet') as counts:
+            body = converter.finish()
+            if body is None:
+                print(f"Could not convert {name} to Parquet, leaving it to Spark: {converter.error}")
+            else:
+                counts.update(bytes=len(body), lines=line_count)
+                s3.put_object(Bucket=parquet_bucket, Body=body,
+                    Key=f"{parquet_key}/{partition}/{name}{str(int(now.timestamp()))}.parquet")
+                outputs.append((parquet_name, parquet_bucket, parquet_key))
+
+    # Projected tables find the partition through their location template
+    partitions = []
+    for output_table, output_bucket, output_key in outputs:
+        with monitoring.span('glue_get_table'):
+            table = glueutils.get_table(env.glue_db, output_table)
+        if not glueutils.uses_projection(table):
+            partitions.append((output_table, glueutils.partition_input(table,
+                [country, year, month, day, secs], f"s3://{output_bucket}/{output_key}/{partition}")))
+
+    return {
+        'line_count': line_count,
+        'output': f"s3://{table_bucket}/{keys[0]}",
+        'parts': len(keys),
+        'table': table_name,
+        'partitions': partitions,
+        'parquet': len(outputs) > 1
+    }
 
+def register_partitions(partitions):
+    """
+    Register (table name, partition input) pairs with one BatchCreatePartition
+    round trip per table and chunk. Returns the tables that failed
+    """
+    by_table = {}
+    for table_name, partition in partitions:
+        by_table.setdefault(table_name, []).append(partition)
+
+    failed = {}
+    for table_name, inputs in by_table.items():
+        print(f"Registering {len(inputs)} partition(s) of {table_name}")
+        try:
+            errors = glueutils.create_partitions(env.glue_db, table_name, inputs)
+        except Exception:
+            failed[table_name] = format_exc()
+            continue
+        if errors:
+            failed[table_name] = json.dumps(errors)
+
+    return failed
+
+def ingest_child(child, zipf, file, name, system, country, now, convert):
+    with child.activate():
+        return ingest_member(zipf, file, name, system, country, now, convert)
+
+def ingest_members(zipf, members, system, country, now, convert=False):
+    """
+    Ingest members with up to `workers` threads, each under a child task of
+    the current one, then register their partitions in batch. With
+    `convert`, members up to `parquet_max_size` bytes are converted to
+    Parquet as well.
+    Outcomes are reported in archive order once all members are done.
+    Returns the total number of lines ingested, the interfaces converted
+    and the interfaces that failed
+    """
+    task = Task.current()
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = []
+        for file in members:
+            name = get_interface_name(file.filename, system)
+            child = task.child(interface=name)
+            futures.append((name, child, monitoring.submit(executor, ingest_child,
+                child, zipf, file, name, system, country, now,
+                convert and file.file_size <= parquet_max_size)))
+
+    ingested = [future.result() for _, _, future in futures if future.exception() is None]
+    with monitoring.span('glue_partitions'):
+        failed_tables = register_partitions([partition
+            for result in ingested for partition in result['partitions']])
+
+    total_line_count = 0
+    converted = []
+    failures = []
+    for name, child, future in futures:
+        error = future.exception()
+        if error is not None:
+            failures.append(name)
+            child.failure("CSV_FAILED", interface=name,
+                exception_message=''.join(format_exception(type(error), error, error.__traceback__)))
+            continue
+
+        result = future.result()
+        failed = [table for table, _ in result['partitions'] if table in failed_tables]
+        if failed:
+            failures.append(name)
+            child.failure("PARTITION_FAILED", interface=name,
+                exception_message=failed_tables[failed[0]])
+            continue
+
+        if result['parquet']:
+            converted.append(name)
+        total_line_count += result['line_count']
+        child.success("CSV_INGESTED",
+            line_count=result['line_count'], interface=name, output=result['output'],
+            parts=result['parts'])
+
+    return total_line_count, converted, failures
+
+def queue_partition(serialized_task, country, ingested, converted):
+    """
+    Queue the partition for processing, with the interfaces ingested and
+    converted, and have the dispatcher pick it up
+    """
+    serialized_task = json.dumps(
+        dlutils.partition_task(json.loads(serialized_task), ingested, converted))
+    with monitoring.span('sqs'):
+        queue_name = dlutils.get_queue_name(env.sqs_prefix, env.env, env.project)
+        queue = sqs.get_queue_by_name(QueueName=queue_name)
+        queue.send_message(MessageBody=serialized_task, MessageGroupId=country)
+
+    fnc.invoke(FunctionName=env.function_process_partition,
+        InvocationType='Event',
+        Payload=json.dumps({
+            'Step': 'initial',
+            'Sentinel': str(uuid.uuid4())
+        }).encode())
+
+def claim_partition(system, country, now):
+    """
+    Claim the partition of an execution time for one archive, moving on to
+    the following seconds while other archives of the system and country
+    hold them. Returns the execution time claimed
+    """
+    locker = LockerClient(env.lock_table)
+    for _ in range(partition_claims):
+        year, month, day, secs = get_partition_values(now)
+        if locker.get_lock(f"{partition_prefix}{system}:{country}:{year}:{month}:{day}:{secs}"):
+            return now
+        now += datetime.timedelta(seconds=1)
+
+    raise RuntimeError(f"No partition left to claim for {system} {country}")
+
+def ingest_archive(key, context, now=None, fanout=None):
+    """
+    Ingest an archive, or with `fanout` the group of its members handed
+    over by a parent invocation, under a task of its own. Archives get a
+    partition of their own, from `now` on
+    """
     system = key.split('/')[level_system]
     country = key.split('/')[level_country].upper()
     if len(country) > 2 or len(key.split('/')) != 5:
@@ -50,89 +415,153 @@ def lambda_handler(event, context):
             f'Check if zip file is in {env.bucket_input}/zips/system/country/zipname.zip'
         )
 
-    # Start tracking 
-    Task.track(system, execution_dt=now,
-        country=country, year=year, month=month, day=day, secs=secs)
-    serialized_task = json.dumps(Task.current().as_dict())
+    if fanout:
+        now = datetime.datetime.strptime(fanout['ExecutionTime'], time_format)
+    else:
+        now = claim_partition(system, country, now or datetime.datetime.utcnow())
 
-    try:
-        obj = s3.get_object(Bucket=env.bucket_input, Key=key)
-        total_line_count = 0
-        with io.BytesIO(obj["Body"].read()) as tf:
-            tf.seek(0)
+    year, month, day, secs = get_partition_values(now)
+    print(key)
+    print(now)
+
+    # Start tracking, the task is current until the archive is done
+    with Task.scope(system, execution_dt=now,
+            country=country, year=year, month=month, day=day, secs=secs) as task:
+        serialized_task = json.dumps(task.as_dict())
+        # Groups fanned out from the archive join under the same id
+        join_id = f"{system}:{country}:{task.execution_id}"
+        joined = False
+
+        try:
+            ranged = reader_mode == 'ranged' or fanout_group_size > 0 or bool(fanout)
             # Read the file as a zipfile and process the members
-            with zipfile.ZipFile(tf, mode='r') as zipf:
-                for file in zipf.infolist():
-                    name = file.filename.split('.')[0].lower()
-                    if name == 'sap':
-                        name = file.filename.split('.')[1].lower()
-                    if name in interfaces[system]:
-                        # Create CSV and Parquet tables
-                        table_name, table_bucket, table_key = glueutils.create_table(system, name, 'csv', os.environ)
-                        glueutils.create_table(system, name, 'parquet', os.environ)
-                        
-                        partition = 'pt_country=' + country + \
-                                   '/pt_year=' + year + \
-                                   '/pt_month=' + month + \
-                                   '/pt_day=' + day + \
-                                   '/pt_secs=' + secs
-
-                        new_filename = f"{name}{str(int(now.timestamp()))}.txt"
-                        fullpath = f"{table_key}/{partition}/{new_filename}"
-                        filebody = zipf.read(file).decode('utf-8', errors='replace')
-                        line_count = filebody.count("\r\n")
-                        total_line_count += line_count
-                        s3.put_object(Bucket=table_bucket, Key=fullpath,
-                            Body=filebody.encode(encoding='utf-8'))
-                        
-                        Task.current().success("CSV_INGESTED",
-                            line_count=line_count, interface=name, output=f"s3://{table_bucket}/{fullpath}")
-
-                        table = dlutils.get_glue_table(glue, env.glue_db, table_name)
-                        new_partition = {
-                            'Values': [country, year, month, day, secs],
-                            'StorageDescriptor': {
-                                'OutputFormat': table['StorageDescriptor']['OutputFormat'],
-                                'InputFormat': table['StorageDescriptor']['InputFormat'],
-                                'SerdeInfo': table['StorageDescriptor']['SerdeInfo'],
-                                'Columns': table['StorageDescriptor']['Columns'],
-                                'Location': f"s3://{table_bucket}/{table_key}/{partition}"
-                            }
-                        }
-
-                        queue_name = dlutils.get_queue_name(env.sqs_prefix, env.env, env.project)
-                        queue = sqs.get_queue_by_name(QueueName=queue_name)
-                        print(new_partition)
-                        
-                        try:
-                            response = glue.create_partition(DatabaseName=env.glue_db,
-                                                                TableName=table['Name'],
-                                                                PartitionInput=new_partition)
-                        except glue.exceptions.AlreadyExistsException as e:
-                            print('AlreadyExistsException')
-                        
-                        try:
-                            queue.send_message(MessageBody=serialized_task, MessageGroupId=country)
-                        except KeyError:
-                            print(response)
-
-        fnc.invoke(FunctionName=env.function_process_partition,
-            InvocationType='Event',
-            Payload=json.dumps({
-                'Step': 'initial',
-                'Sentinel': str(uuid.uuid4())
-            }).encode())
+            with open_archive(key, ranged) as zipf:
+                members = [file for file in zipf.infolist()
+                    if get_interface_name(file.filename, system) in interfaces[system]]
+                if fanout:
+                    members = [file for file in members if file.filename in fanout['Members']]
+
+                # Hand groups of members to other invocations, they take it from here
+                if not fanout and fanout_group_size and len(members) > fanout_group_size:
+                    groups = fan_out(key, [file.filename for file in members], now, join_id,
+                        serialized_task, context)
+                    task.success("ZIP_DISPATCHED",
+                        groups=len(groups), members=len(members))
+                    return
+
+                convert = bool(parquet_max_size) and parquetutils.available()
+                total_line_count, converted, failures = ingest_members(zipf, members,
+                    system, country, now, convert)
+                name = get_interface_name(members[-1].filename, system) if members else None
+
+            outcome = {
+                'line_count': total_line_count,
+                'interfaces': sorted(set(get_interface_name(file.filename, system)
+                    for file in members) - set(failures)),
+                'converted': converted
+            }
+            if fanout:
+                # Only the last group to land goes on, once every group
+                # wrote its interfaces, with the totals of all of them
+                outcome = FanoutJoin(env.lock_table).arrive(join_id, fanout['Group'], **outcome)
+                joined = True
+
+            if outcome and outcome['interfaces']:
+                queue_partition(serialized_task, country,
+                    outcome['interfaces'], outcome['converted'])
+
+            if failures:
+                raise IngestionError(failures)
 
-        Task.current().success("ZIP_INGESTED",
-            line_count=total_line_count, interface=name)
+            if outcome:
+                task.success("ZIP_INGESTED",
+                    line_count=outcome['line_count'], interface=name)
+            else:
+                task.success("GROUP_INGESTED",
+                    line_count=total_line_count, interface=name)
 
-    except Exception as e:
-        # Log failure
-        Task.current().failure("UNZIP_FAILED", exception_message=format_exc())
-        
-        # Print and stop lambda
-        print(e)
-        raise e from None
+        except Exception as e:
+            # Log failure
+            task.failure("UNZIP_FAILED", exception_message=format_exc())
+
+            # Print and stop
+            print(e)
+            if not fanout:
+                raise e from None
+
+            # A group that failed still joins, or the partition would wait
+            # for it forever. It isn't retried, by then the partition may
+            # already be on its way
+            if not joined:
+                outcome = FanoutJoin(env.lock_table).arrive(join_id, fanout['Group'])
+                if outcome and outcome['interfaces']:
+                    queue_partition(serialized_task, country,
+                        outcome['interfaces'], outcome['converted'])
+            return
 
     sns.publish(TopicArn=env.sns_topic,
         Message=f'Lambda {serialized_task} executada com sucesso.')
+
+def get_archive_keys(event):
+    """
+    List the (message id, archive key) pairs of an event. S3 notifications
+    come either directly or through an SQS queue, in which case each
+    message carries a notification (message id None for direct ones).
+    Messages that aren't S3 notifications get a None key
+    """
+    archives = []
+    for record in event.get('Records', []):
+        if record.get('eventSource') != 'aws:sqs':
+            archives.append((None, record['s3']['object']['key']))
+            continue
+
+        try:
+            # S3 test events carry no records
+            notification = json.loads(record['body'])
+            keys = [inner['s3']['object']['key'] for inner in notification.get('Records', [])]
+        except (ValueError, KeyError, TypeError):
+            print(f"Unreadable message {record['messageId']}: {record['body']}")
+            keys = [None]
+        archives.extend((record['messageId'], key) for key in keys)
+    return archives
+
+def lambda_handler(event, context):
+    print('Start: ' + str(event))
+    if isinstance(event, str):
+        event = json.loads(event)
+
+    try:
+        # Invoked by a parent invocation for a group of members
+        fanout = event.get('Fanout')
+        if fanout:
+            ingest_archive(fanout['Key'], context, fanout=fanout)
+            return
+
+        # Every archive of the event is ingested, each under its own task
+        # and in a partition of its own claimed from the same time on
+        now = datetime.datetime.utcnow()
+        archives = get_archive_keys(event)
+        failed = [(message_id, key, ValueError(f"Unreadable message {message_id}"))
+            for message_id, key in archives if key is None]
+        archives = [(message_id, key) for message_id, key in archives if key is not None]
+
+        with ThreadPoolExecutor(max_workers=max(min(record_workers, len(archives)), 1)) as executor:
+            futures = [(message_id, key, monitoring.submit(executor, ingest_archive, key, context, now))
+                for message_id, key in archives]
+        failed.extend((message_id, key, future.exception()) for message_id, key, future in futures
+            if future.exception() is not None)
+    finally:
+        # Monitoring events are buffered, send them before the container freezes
+        monitoring.flush()
+
+    # Only the messages that failed go back to the queue
+    if any(record.get('eventSource') == 'aws:sqs' for record in event.get('Records', [])):
+        return {
+            'batchItemFailures': [{'itemIdentifier': message_id}
+                for message_id in sorted({message_id for message_id, _, _ in failed})]
+        }
+
+    if len(archives) == 1 and failed:
+        raise failed[0][2]
+    if failed:
+        raise BatchError([key for _, key, _ in failed])
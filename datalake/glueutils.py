@@ -1,9 +1,54 @@
 # Utilities for handling Glue
 import datetime
+import json
+import os
+import threading
+import time
 import boto3
+import compression
 import dlutils
+from botocore.exceptions import ClientError
 from typing import List, Dict
 
+# Shared clients, creating clients from the default session isn't thread safe
+glue = boto3.client('glue')
+s3 = boto3.client('s3')
+
+class CatalogCache:
+    """
+    Process-level cache of Glue table definitions keyed by (database, table).
+    It outlives a single invocation, so warm containers skip catalog reads
+    until an entry expires after `ttl` seconds or is invalidated.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, database: str, name: str):
+        with self.lock:
+            entry = self.entries.get((database, name))
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def put(self, database: str, name: str, table: dict):
+        with self.lock:
+            self.entries[(database, name)] = (time.monotonic() + self.ttl, table)
+
+    def invalidate(self, database: str = None, name: str = None):
+        """
+        Drop a single table, a whole database or (no arguments) everything
+        """
+        with self.lock:
+            for cached_database, cached_name in list(self.entries):
+                if database not in (None, cached_database) or name not in (None, cached_name):
+                    continue
+                del self.entries[(cached_database, cached_name)]
+
+catalog = CatalogCache(float(os.environ.get('glue_cache_ttl', 900)))
+
 GLUE_TABLE_FORMATS = {
     'csv': {
         'Input': 'org.apache.hadoop.mapred.TextInputFormat',
@@ -16,7 +61,8 @@ GLUE_TABLE_FORMATS = {
         },
         'Prefix': '',
         'Key': lambda t, env: f"{env['glue_s3_key']}/csv/{t}",
-        'Bucket': lambda env: env['bucket_output']
+        'Bucket': lambda env: env['bucket_output'],
+        'Codec': lambda env: compression.get_codec(env.get('csv_output_codec'))
     },
     'parquet': {
         'Input': 'org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat',
@@ -33,6 +79,9 @@ GLUE_TABLE_FORMATS = {
     }
 }
 
+# BatchCreatePartition accepts at most 100 partitions per call
+PARTITION_BATCH_SIZE = 100
+
 DEFAULT_PARTITION_KEYS = [
     {'Name': 'pt_country', 'Type': 'string'},
     {'Name': 'pt_year', 'Type': 'string'},
@@ -41,9 +90,50 @@ DEFAULT_PARTITION_KEYS = [
     {'Name': 'pt_secs', 'Type': 'string'}
 ]
 
-def table_spec(table_name: str, kind: str, s3_path: str, columns: List[str]):
+# pt_secs is computed as hour * 24 * 60 + minute * 60 + second
+MAX_PARTITION_SECS = 23 * 24 * 60 + 59 * 60 + 59
+
+DEFAULT_PROJECTION_COUNTRIES = 'BO,CL,CO,CR,DO,EC,GT,MX,PA,PE,PR,SV'
+
+def projection_parameters(s3_path: str, env: Dict[str, str]) -> Dict[str, str]:
+    """
+    Returns table parameters enabling partition projection over
+    DEFAULT_PARTITION_KEYS, so partitions don't need to be registered.
+    pt_secs is injected by default (queries must filter on it), set
+    projection_secs_type=integer to project its whole range instead
+    """
+
+    secs_type = env.get('projection_secs_type', 'injected')
+    parameters = {
+        'projection.enabled': 'true',
+        'projection.pt_country.type': 'enum',
+        'projection.pt_country.values': env.get('projection_countries', DEFAULT_PROJECTION_COUNTRIES),
+        'projection.pt_year.type': 'integer',
+        'projection.pt_year.range': env.get('projection_year_range', '2018,2099'),
+        'projection.pt_month.type': 'integer',
+        'projection.pt_month.range': '1,12',
+        'projection.pt_day.type': 'integer',
+        'projection.pt_day.range': '1,31',
+        'projection.pt_secs.type': secs_type,
+        'storage.location.template': s3_path + '/' + '/'.join(
+            f"{key['Name']}=${{{key['Name']}}}" for key in DEFAULT_PARTITION_KEYS)
+    }
+    if secs_type == 'integer':
+        parameters['projection.pt_secs.range'] = f"0,{MAX_PARTITION_SECS}"
+
+    return parameters
+
+def uses_projection(table: dict) -> bool:
+    """
+    Check if partitions of a table are projected rather than registered
+    """
+    return table.get('Parameters', {}).get('projection.enabled') == 'true'
+
+def table_spec(table_name: str, kind: str, s3_path: str, columns: List[str],
+        parameters: Dict[str, str] = None, compressed: bool = True):
     """
     Returns a valid table spec for use with Glue CreateTable API
+    Extra table `parameters` (e.g. partition projection) are merged in
     """
 
     formats = GLUE_TABLE_FORMATS[kind]
@@ -52,7 +142,7 @@ def table_spec(table_name: str, kind: str, s3_path: str, columns: List[str]):
         'Name': table_name,
         'StorageDescriptor': {
             'Columns': columns,
-            'Compressed': True,
+            'Compressed': compressed,
             'Location': s3_path,
             'InputFormat': formats['Input'],
             'OutputFormat': formats['Output'],
@@ -66,7 +156,8 @@ def table_spec(table_name: str, kind: str, s3_path: str, columns: List[str]):
         'Parameters': {
             'EXTERNAL': 'TRUE',
             'classification': kind,
-            'creationDate': datetime.datetime.utcnow().isoformat()
+            'creationDate': datetime.datetime.utcnow().isoformat(),
+            **(parameters or {})
         }
     }
 
@@ -93,25 +184,159 @@ def parse_fmt(data: str) -> List[Dict[str, str]]:
 
     return columns
 
-def load_fmt(system: str, interface: str, env: Dict[str, str]) -> str:
+class SchemaRegistry:
     """
-    Load a FMT file from S3.
+    Cache of parsed FMT column specs keyed by (system, interface). Entries
+    live in memory and under `cache_dir`, and are revalidated against the
+    FMT ETag with a conditional GET once they are older than `check_interval`
+    seconds, so unchanged FMTs cost at most a 304 per interval.
     """
 
-    s3 = boto3.resource('s3')
-    key = f"{env['key_prefix_fmt']}/{system}/{interface}.fmt"
-    print(f"Loading FMT {env['bucket_output']}/{key}")
-    fmt = s3.Object(env['bucket_output'], f"{env['key_prefix_fmt']}/{system}/{interface}.fmt")
-    return fmt.get()['Body'].read().decode()
+    def __init__(self, cache_dir: str, check_interval: float):
+        self.cache_dir = cache_dir
+        self.check_interval = check_interval
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def _path(self, system: str, interface: str) -> str:
+        return os.path.join(self.cache_dir, system, f"{interface}.json")
+
+    def _load(self, system: str, interface: str):
+        with self.lock:
+            entry = self.entries.get((system, interface))
+        if entry is not None:
+            return entry
+
+        try:
+            with open(self._path(system, interface)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        with self.lock:
+            self.entries[(system, interface)] = entry
+        return entry
+
+    def _store(self, system: str, interface: str, entry: dict):
+        with self.lock:
+            self.entries[(system, interface)] = entry
+
+        # Written through a temporary file so readers never see half an entry
+        path = self._path(system, interface)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.{threading.get_ident()}", 'w') as f:
+                json.dump(entry, f)
+            os.replace(f"{path}.{threading.get_ident()}", path)
+        except OSError as e:
+            print(f"Could not cache FMT {system}/{interface}: {e}")
+
+    def seed(self, system: str, interface: str, etag: str, columns: List[Dict[str, str]]):
+        """
+        Record a known version (e.g. the one a table was created from) if the
+        registry has none yet. It is revalidated on the next lookup
+        """
+        if self._load(system, interface) is None:
+            self._store(system, interface, {'etag': etag, 'columns': columns, 'checked_at': 0})
+
+    def get(self, system: str, interface: str, env: Dict[str, str]) -> dict:
+        """
+        Return the current entry ({'etag', 'columns', 'checked_at'}) for an
+        interface, fetching the FMT from S3 only if it changed
+        """
+        entry = self._load(system, interface)
+        if entry is not None and time.time() - entry['checked_at'] < self.check_interval:
+            return entry
+
+        key = f"{env['key_prefix_fmt']}/{system}/{interface}.fmt"
+        params = {'Bucket': env['bucket_output'], 'Key': key}
+        if entry is not None:
+            params['IfNoneMatch'] = entry['etag']
+
+        try:
+            fmt = s3.get_object(**params)
+        except ClientError as e:
+            if e.response['ResponseMetadata'].get('HTTPStatusCode') != 304:
+                raise
+            entry = dict(entry, checked_at=time.time())
+        else:
+            print(f"Loading FMT {env['bucket_output']}/{key}")
+            entry = {
+                'etag': fmt['ETag'],
+                'columns': parse_fmt(fmt['Body'].read().decode()),
+                'checked_at': time.time()
+            }
 
-def table_exists(database: str, name: str) -> bool:
+        self._store(system, interface, entry)
+        return entry
+
+registry = SchemaRegistry(os.environ.get('fmt_cache_dir', '/tmp/fmt-cache'),
+    float(os.environ.get('fmt_check_interval', 3600)))
+
+# Attributes of a GetTable result that UpdateTable accepts back
+TABLE_INPUT_FIELDS = ['Name', 'Description', 'Owner', 'LastAccessTime', 'LastAnalyzedTime',
+    'Retention', 'StorageDescriptor', 'PartitionKeys', 'ViewOriginalText',
+    'ViewExpandedText', 'TableType', 'Parameters']
+
+def check_schema(table: dict, system: str, interface: str, kind: str, env: Dict[str, str]) -> dict:
+    """
+    Compare the columns of an existing table with its current FMT. On drift,
+    tables of the kinds listed in fmt_drift_update (default csv) are updated,
+    others are only reported. Returns the (possibly updated) table.
+    The check is best effort: if the FMT can't be read or the table can't
+    be updated, the table is returned as it is
+    """
+
+    parameters = table.get('Parameters', {})
+    columns = table['StorageDescriptor']['Columns']
+    if parameters.get('fmt_etag'):
+        registry.seed(system, interface, parameters['fmt_etag'],
+            [{'Name': column['Name'], 'Type': 'string'} for column in columns])
+
+    try:
+        schema = registry.get(system, interface, env)
+    except Exception as e:
+        print(f"Failed to check the schema of {table['Name']}: {e}")
+        return table
+    if schema['etag'] == parameters.get('fmt_etag'):
+        return table
+    if [column['Name'] for column in columns] == [column['Name'] for column in schema['columns']]:
+        return table
+
+    print(f"Schema drift detected for {table['Name']}")
+    if kind not in env.get('fmt_drift_update', 'csv').split(','):
+        return table
+
+    updated = {field: table[field] for field in TABLE_INPUT_FIELDS if field in table}
+    updated['StorageDescriptor'] = dict(table['StorageDescriptor'], Columns=schema['columns'])
+    updated['Parameters'] = dict(parameters, fmt_etag=schema['etag'])
+    try:
+        glue.update_table(DatabaseName=env['glue_db'], TableInput=updated)
+    except Exception as e:
+        print(f"Failed to update the schema of {table['Name']}: {e}")
+        return table
+
+    table = dict(updated, DatabaseName=env['glue_db'])
+    catalog.put(env['glue_db'], table['Name'], table)
+    return table
+
+def get_table(database: str, name: str):
     """
-    Check if given table exists in the Glue catalog
+    Return a table definition from the catalog cache, looking it up by
+    exact name on a miss. Returns None if the table doesn't exist
     """
 
-    glue = boto3.client('glue')
-    resp = glue.get_tables(DatabaseName=database, Expression=f".*{name}.*")
-    return len(resp['TableList']) > 0
+    table = catalog.get(database, name)
+    if table is not None:
+        return table
+
+    try:
+        table = glue.get_table(DatabaseName=database, Name=name)['Table']
+    except glue.exceptions.EntityNotFoundException:
+        return None
+
+    catalog.put(database, name, table)
+    return table
 
 def create_table(system: str, interface: str, kind: str, env: Dict[str, str]):
     """
@@ -125,17 +350,77 @@ def create_table(system: str, interface: str, kind: str, env: Dict[str, str]):
     key = formats['Key'](table_name, env)
     s3_path = f"s3://{bucket}/{key}"
 
-    if table_exists(env['glue_db'], table_name):
+    table = get_table(env['glue_db'], table_name)
+    if table is not None:
+        check_schema(table, system, interface, kind, env)
         return table_name, bucket, key
 
-    columns = parse_fmt(load_fmt(system, interface, env))
-    table = table_spec(table_name, kind, s3_path, columns)
+    schema = registry.get(system, interface, env)
+    parameters = {'fmt_etag': schema['etag']}
 
-    glue = boto3.client('glue')
+    # Table kinds listed in glue_partition_projection get projected partitions
+    if kind in env.get('glue_partition_projection', '').split(','):
+        parameters.update(projection_parameters(s3_path, env))
+
+    # Text tables record the codec their files are written with. Readers go
+    # by file extension, so files written before a codec change still work
+    compressed = True
+    if 'Codec' in formats:
+        codec = formats['Codec'](env)
+        parameters['compressionType'] = codec.table_type
+        compressed = codec.compressed
+
+    table = table_spec(table_name, kind, s3_path, schema['columns'], parameters, compressed)
 
     try:
         glue.create_table(DatabaseName=env['glue_db'], TableInput=table)
+        catalog.put(env['glue_db'], table_name, dict(table, DatabaseName=env['glue_db']))
     except glue.exceptions.AlreadyExistsException:
         print(f"{table_name} already exists")
 
     return table_name, bucket, key
+
+def partition_input(table: dict, values: List[str], location: str) -> dict:
+    """
+    Returns a PartitionInput that reuses the storage descriptor of `table`
+    """
+
+    descriptor = table['StorageDescriptor']
+    return {
+        'Values': values,
+        'StorageDescriptor': {
+            'OutputFormat': descriptor['OutputFormat'],
+            'InputFormat': descriptor['InputFormat'],
+            'SerdeInfo': descriptor['SerdeInfo'],
+            'Columns': descriptor['Columns'],
+            'Location': location
+        }
+    }
+
+def create_partitions(database: str, table_name: str, partitions: List[dict]) -> List[dict]:
+    """
+    Register partitions of a table with BatchCreatePartition, in chunks.
+    Partitions that already exist are skipped, other per-entry errors are returned
+    """
+
+    errors = []
+    for start in range(0, len(partitions), PARTITION_BATCH_SIZE):
+        chunk = partitions[start:start + PARTITION_BATCH_SIZE]
+        try:
+            response = glue.batch_create_partition(DatabaseName=database,
+                TableName=table_name, PartitionInputList=chunk)
+        except glue.exceptions.EntityNotFoundException:
+            # Table was dropped behind our back, don't keep serving it
+            catalog.invalidate(database, table_name)
+            raise
+
+        for error in response.get('Errors', []):
+            code = error['ErrorDetail']['ErrorCode']
+            if code == 'AlreadyExistsException':
+                print(f"Partition {error['PartitionValues']} of {table_name} already exists")
+                continue
+            if code == 'EntityNotFoundException':
+                catalog.invalidate(database, table_name)
+            errors.append(error)
+
+    return errors
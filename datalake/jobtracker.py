@@ -0,0 +1,241 @@
+import boto3
+import json
+
+from datetime import datetime, timedelta
+
+class JobTracker():
+    """
+    Keeps the Livy job currently running for each country and step DAG
+    node in the lock table (as 'emrsteps:job:{country}:{node}' items, the
+    node being the step plus the interface of fanned out steps), so that
+    jobs that die without calling back can be found and reconciled. Jobs
+    waiting to be submitted carry a 'deferredUntil' timestamp instead of
+    a Livy id.
+
+    A job is identified by its step, attempt and execution id. A callback
+    only counts if it matches the tracked job; once the reconciler claimed
+    a job, only its synthetic callback does.
+    """
+
+    prefix = 'emrsteps:job:'
+
+    def __init__(self, tableName):
+        self.tableName = tableName
+        self.db = boto3.client('dynamodb')
+
+    def key(self, step, task):
+        node = f"{step}:{task['interface']}" if task.get('interface') else step
+        return {
+            'name': {
+                'S': f"{self.prefix}{task['country']}:{node}"
+            }
+        }
+
+    def identity(self, step, task):
+        return {
+            ':step': {
+                'S': step
+            },
+            ':attempt': {
+                'N': str(task['attempt'])
+            },
+            ':executionId': {
+                'S': str(task['execution_id'])
+            }
+        }
+
+    def track(self, step, task, job):
+        """
+        Record the Livy batch or session statement running `step` for a task
+        """
+        now = datetime.utcnow()
+        item = {
+            **self.key(step, task),
+            'step': {
+                'S': step
+            },
+            'attempt': {
+                'N': str(task['attempt'])
+            },
+            'executionId': {
+                'S': str(task['execution_id'])
+            },
+            'task': {
+                'S': json.dumps(task)
+            },
+            'submittedAt': {
+                'N': str(now.timestamp())
+            },
+            'ttl': {
+                'N': str((now + timedelta(days=2)).timestamp())
+            }
+        }
+        if 'session' in job:
+            item['sessionId'] = {'N': str(job['session'])}
+            item['statementId'] = {'N': str(job['id'])}
+        else:
+            item['batchId'] = {'N': str(job['id'])}
+
+        self.db.put_item(TableName=self.tableName, Item=item)
+
+    def defer(self, step, task, delay, deferrals=0):
+        """
+        Record that `step` for a task has to be submitted in `delay` seconds,
+        either to back off a retry or because the cluster is full. The
+        reconciler submits it once due
+        """
+        now = datetime.utcnow()
+        item = {
+            **self.key(step, task),
+            'step': {
+                'S': step
+            },
+            'attempt': {
+                'N': str(task['attempt'])
+            },
+            'executionId': {
+                'S': str(task['execution_id'])
+            },
+            'task': {
+                'S': json.dumps(task)
+            },
+            'submittedAt': {
+                'N': str(now.timestamp())
+            },
+            'deferredUntil': {
+                'N': str(now.timestamp() + delay)
+            },
+            'deferrals': {
+                'N': str(deferrals)
+            },
+            'ttl': {
+                'N': str((now + timedelta(days=2)).timestamp())
+            }
+        }
+
+        self.db.put_item(TableName=self.tableName, Item=item)
+
+    def untrack(self, step, task, reconciled=False):
+        """
+        Remove the job of a task on callback. Returns the task as it was
+        submitted ({} if it wasn't tracked), or None if the callback is
+        stale, i.e. another job is tracked for the node or the job was
+        already claimed by the reconciler (unless `reconciled` is set)
+        """
+        matches = '#step = :step AND attempt = :attempt AND executionId = :executionId'
+        names = {'#step': 'step'}
+        if reconciled:
+            condition = f"{matches} AND attribute_exists(reconciled)"
+        else:
+            condition = f"attribute_not_exists(#name) OR ({matches} AND attribute_not_exists(reconciled))"
+            names['#name'] = 'name'
+
+        try:
+            response = self.db.delete_item(TableName=self.tableName, Key=self.key(step, task),
+                ConditionExpression=condition,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=self.identity(step, task),
+                ReturnValues='ALL_OLD')
+        except self.db.exceptions.ConditionalCheckFailedException:
+            return None
+
+        item = response.get('Attributes')
+        return json.loads(item['task']['S']) if item else {}
+
+    def claim(self, job):
+        """
+        Mark a tracked job as reconciled. Returns False if its callback
+        arrived (or another reconciler claimed it) in the meantime
+        """
+        try:
+            self.db.update_item(TableName=self.tableName, Key=self.key(job['step'], job['task']),
+                UpdateExpression='SET reconciled = :now',
+                ConditionExpression='#step = :step AND attempt = :attempt '
+                    'AND executionId = :executionId AND attribute_not_exists(reconciled)',
+                ExpressionAttributeNames={'#step': 'step'},
+                ExpressionAttributeValues={
+                    **self.identity(job['step'], job['task']),
+                    ':now': {'N': str(datetime.utcnow().timestamp())}
+                })
+            return True
+        except self.db.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def claim_deferred(self, job, lease):
+        """
+        Take a deferred job for `lease` seconds to submit it. Returns False
+        if someone else holds it. The job stays pending, so if it's neither
+        submitted nor deferred again in time it is due again
+        """
+        now = datetime.utcnow().timestamp()
+        try:
+            self.db.update_item(TableName=self.tableName, Key=self.key(job['step'], job['task']),
+                UpdateExpression='SET claimedUntil = :until',
+                ConditionExpression='#step = :step AND attempt = :attempt '
+                    'AND executionId = :executionId AND attribute_exists(deferredUntil) '
+                    'AND (attribute_not_exists(claimedUntil) OR claimedUntil < :now)',
+                ExpressionAttributeNames={'#step': 'step'},
+                ExpressionAttributeValues={
+                    **self.identity(job['step'], job['task']),
+                    ':now': {'N': str(now)},
+                    ':until': {'N': str(now + lease)}
+                })
+            return True
+        except self.db.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def mark_finished(self, job):
+        """
+        Record when a job was first seen finished, returns that timestamp
+        """
+        now = datetime.utcnow().timestamp()
+        try:
+            self.db.update_item(TableName=self.tableName, Key=self.key(job['step'], job['task']),
+                UpdateExpression='SET finishedAt = :now',
+                ConditionExpression='#step = :step AND attempt = :attempt '
+                    'AND executionId = :executionId AND attribute_not_exists(finishedAt)',
+                ExpressionAttributeNames={'#step': 'step'},
+                ExpressionAttributeValues={
+                    **self.identity(job['step'], job['task']),
+                    ':now': {'N': str(now)}
+                })
+        except self.db.exceptions.ConditionalCheckFailedException:
+            pass
+        return now
+
+    def pending(self):
+        """
+        Return every tracked job not yet claimed by the reconciler.
+        Deferred jobs are returned even while taken for submission
+        """
+        jobs = []
+        params = {
+            'TableName': self.tableName,
+            'FilterExpression': 'begins_with(#name, :prefix) AND attribute_not_exists(reconciled)',
+            'ExpressionAttributeNames': {'#name': 'name'},
+            'ExpressionAttributeValues': {':prefix': {'S': self.prefix}},
+            'ConsistentRead': True
+        }
+
+        while True:
+            response = self.db.scan(**params)
+            for item in response['Items']:
+                job = {
+                    'step': item['step']['S'],
+                    'task': json.loads(item['task']['S']),
+                    'submittedAt': float(item['submittedAt']['N']),
+                    'finishedAt': float(item['finishedAt']['N']) if 'finishedAt' in item else None
+                }
+                if 'deferredUntil' in item:
+                    job['deferredUntil'] = float(item['deferredUntil']['N'])
+                    job['deferrals'] = int(item['deferrals']['N'])
+                elif 'batchId' in item:
+                    job['batchId'] = int(item['batchId']['N'])
+                else:
+                    job['sessionId'] = int(item['sessionId']['N'])
+                    job['statementId'] = int(item['statementId']['N'])
+                jobs.append(job)
+
+            if 'LastEvaluatedKey' not in response:
+                return jobs
+            params['ExclusiveStartKey'] = response['LastEvaluatedKey']
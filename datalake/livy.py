@@ -0,0 +1,265 @@
+# Client for the Livy REST API running on the EMR master
+import json
+import random
+import threading
+import time
+import uuid
+import requests
+import urllib3
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+# Interactive sessions in these states will never run statements again
+SESSION_DEAD_STATES = ('shutting_down', 'error', 'dead', 'killed', 'success')
+# Final states of batches and statements
+BATCH_FAILED_STATES = ('error', 'dead', 'killed')
+BATCH_FINISHED_STATES = ('success',)
+STATEMENT_FAILED_STATES = ('error', 'cancelling', 'cancelled')
+# Requests that can be repeated without side effects
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'DELETE')
+
+def never_sent(error: requests.exceptions.RequestException) -> bool:
+    """
+    Check if a connection error or timeout happened while connecting,
+    before any of the request was sent
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError,
+        urllib3.exceptions.ConnectTimeoutError))
+
+class LivyClient:
+    """
+    Livy REST client with a persistent, connection-pooled session, explicit
+    timeouts and bounded retries with full jitter on 5xx responses and
+    connection errors. Only idempotent requests are retried once they may
+    have reached Livy (read timeouts, dropped connections, 5xx); others are
+    only retried when the connection couldn't be established.
+    """
+
+    def __init__(self, host: str, port: int = 8998, connect_timeout: float = 5,
+            read_timeout: float = 30, retries: int = 3, backoff: float = 0.5,
+            pool_size: int = 10):
+        self.url = f"http://{host}:{port}"
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.headers.update({'Content-Type': 'application/json'})
+
+    def sleep(self, attempt: int):
+        time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def request(self, method: str, path: str, **kwargs):
+        idempotent = method in IDEMPOTENT_METHODS
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.request(method, self.url + path,
+                    timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # Read timeouts aren't connection errors, both may have reached Livy
+                if attempt == self.retries or not (idempotent or never_sent(e)):
+                    raise
+                print(f"Livy {method} {path} failed ({e}), retrying")
+            else:
+                if response.status_code < 500 or attempt == self.retries or not idempotent:
+                    response.raise_for_status()
+                    return response.json() if response.content else {}
+                print(f"Livy {method} {path} returned {response.status_code}, retrying")
+
+            self.sleep(attempt)
+
+    def find_batch(self, name: str):
+        """
+        Return the batch with the given name, None if Livy has none
+        """
+        start, size = 0, 100
+        while True:
+            batches = self.list_batches(start, size)
+            for batch in batches:
+                if batch.get('name') == name:
+                    return batch
+            if len(batches) < size:
+                return None
+            start += size
+
+    def submit_batch(self, body: dict) -> dict:
+        """
+        Submit a batch job, returns the batch description (id, state, ...).
+        Batches get a unique name, so that when a submission may have
+        reached Livy without an answer (dropped connection, read timeout,
+        5xx) the batch is looked up before submitting it again
+        """
+        if not body.get('name'):
+            body = dict(body, name=f"{body['className'].split('.')[-1]}-{uuid.uuid4().hex[:12]}")
+
+        for attempt in range(self.retries + 1):
+            try:
+                return self.request('POST', '/batches', json=body)
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code < 500:
+                    raise
+                error = e
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+
+            batch = self.find_batch(body['name'])
+            if batch is not None:
+                print(f"Livy batch {body['name']} was created despite {error}")
+                return batch
+            if attempt == self.retries:
+                raise error
+            print(f"Livy batch {body['name']} wasn't created ({error}), retrying")
+            self.sleep(attempt)
+
+    def submit_batches(self, bodies: list) -> list:
+        """
+        Submit several batch jobs concurrently. Returns, in order, either
+        the batch description or the exception raised for each body
+        """
+        if not bodies:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(len(bodies), self.pool_size)) as executor:
+            futures = [executor.submit(self.submit_batch, body) for body in bodies]
+
+        return [future.exception() or future.result() for future in futures]
+
+    def get_batch(self, batch_id: int) -> dict:
+        return self.request('GET', f"/batches/{batch_id}")
+
+    def get_batch_state(self, batch_id: int) -> str:
+        return self.request('GET', f"/batches/{batch_id}/state")['state']
+
+    def get_batch_log(self, batch_id: int, start: int = 0, size: int = 100) -> list:
+        """
+        Return `size` lines of the batch log starting from line `start`
+        """
+        return self.request('GET', f"/batches/{batch_id}/log",
+            params={'from': start, 'size': size})['log']
+
+    def list_batches(self, start: int = 0, size: int = 100) -> list:
+        return self.request('GET', '/batches',
+            params={'from': start, 'size': size})['sessions']
+
+    def delete_batch(self, batch_id: int):
+        return self.request('DELETE', f"/batches/{batch_id}")
+
+    def create_session(self, body: dict) -> dict:
+        return self.request('POST', '/sessions', json=body)
+
+    def list_sessions(self, start: int = 0, size: int = 100) -> list:
+        return self.request('GET', '/sessions',
+            params={'from': start, 'size': size})['sessions']
+
+    def delete_session(self, session_id: int):
+        return self.request('DELETE', f"/sessions/{session_id}")
+
+    def submit_statement(self, session_id: int, code: str) -> dict:
+        return self.request('POST', f"/sessions/{session_id}/statements", json={'code': code})
+
+    def get_statement(self, session_id: int, statement_id: int) -> dict:
+        return self.request('GET', f"/sessions/{session_id}/statements/{statement_id}")
+
+def scala_main_call(class_name: str, args: list) -> str:
+    """
+    Scala statement calling `class_name.main` with the given arguments.
+    JSON string escaping is valid for Scala string literals
+    """
+    literals = ', '.join(json.dumps(str(arg), ensure_ascii=False) for arg in args)
+    return f"{class_name}.main(Array[String]({literals}))"
+
+class SessionPool:
+    """
+    Pool of long-running Livy interactive sessions, recognized by a name
+    prefix, that run step classes as statements instead of paying for a
+    new Spark application per step. Statements go to an idle session;
+    sessions that died (e.g. a step called System.exit) or that are older
+    than `max_age` seconds are recycled. When no session is idle, a new one
+    is started for later use (up to `size`) and None is returned so the
+    caller can fall back to a batch.
+
+    Sessions are handed out under a lock and only once per dispatch pass
+    (see `begin_pass`), so statements submitted by concurrent threads never
+    queue up on the same session.
+    """
+
+    def __init__(self, client: LivyClient, prefix: str, session_body: dict,
+            size: int = 2, max_age: float = 4 * 3600):
+        self.client = client
+        self.prefix = prefix
+        self.session_body = session_body
+        self.size = size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # Sessions handed out during the current pass
+        self.taken = set()
+
+    def begin_pass(self):
+        """
+        Make every idle session available again, e.g. for a new dispatch pass
+        """
+        with self.lock:
+            self.taken.clear()
+
+    def sessions(self) -> list:
+        return [session for session in self.client.list_sessions()
+            if (session.get('name') or '').startswith(f"{self.prefix}-")]
+
+    def created_at(self, session: dict) -> float:
+        # Names look like {prefix}-{created at}-{random suffix}
+        return float(session['name'][len(self.prefix) + 1:].split('-')[0])
+
+    def start(self) -> dict:
+        name = f"{self.prefix}-{int(time.time())}-{uuid.uuid4().hex[:8]}"
+        print(f"Starting Livy session {name}")
+        return self.client.create_session(dict(self.session_body, name=name))
+
+    def acquire(self):
+        """
+        Return the id of a healthy idle session not handed out yet in this
+        pass, or None if there is none
+        """
+        with self.lock:
+            alive = 0
+            idle = []
+            for session in self.sessions():
+                if session['state'] in SESSION_DEAD_STATES:
+                    print(f"Removing Livy session {session['id']} ({session['state']})")
+                    self.client.delete_session(session['id'])
+                    continue
+                if session['state'] == 'idle' and time.time() - self.created_at(session) > self.max_age:
+                    print(f"Recycling Livy session {session['id']}")
+                    self.client.delete_session(session['id'])
+                    continue
+
+                alive += 1
+                if session['state'] == 'idle' and session['id'] not in self.taken:
+                    idle.append(session)
+
+            if idle:
+                session_id = random.choice(idle)['id']
+                self.taken.add(session_id)
+                return session_id
+
+            # Sessions started earlier are listed, even while still starting
+            if alive < self.size:
+                self.start()
+            return None
+
+    def run(self, code: str):
+        """
+        Run a statement on an idle session. Returns the statement along with
+        its session id, or None if no session was available
+        """
+        session_id = self.acquire()
+        if session_id is None:
+            return None
+
+        statement = self.client.submit_statement(session_id, code)
+        return dict(statement, session=session_id)
@@ -1,14 +1,17 @@
 import boto3
 import uuid
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 class LockerClient():
     def __init__(self, lockTableName):
         self.lockTableName = lockTableName
         self.db = boto3.client('dynamodb')
+        # guid of every lock acquired through this client, used to renew them
+        self.guids = {}
 
-    def get_lock(self, lockName, expiresOn=None):
+    def get_lock(self, lockName, expiresOn=None, owner=None):
         now = datetime.utcnow()
 
         # Set TTL for lock (6 hours from execution time)
@@ -18,20 +21,11 @@ class LockerClient():
         if not expiresOn:
             expiresOn = ttl
 
-        # First get the row for 'name'
-        get_item_params = {
-            'TableName': self.lockTableName,
-            'Key': {
-                'name': {
-                    'S': lockName,
-                }
-            },
-            'AttributesToGet': [
-                'requestedAt', 'expiresOn', 'guid'
-            ],
-            'ConsistentRead': True,
-        }
+        guid = str(uuid.uuid4())
 
+        # A single conditional write: it only succeeds if nobody holds the
+        # lock or the current holder let it expire, so two clients can never
+        # both take over the same expired lock
         put_item_params = {
             'Item': {
                 'name': {
@@ -41,7 +35,7 @@ class LockerClient():
                     'S': now.isoformat()
                 },
                 'guid': {
-                    'S': str(uuid.uuid4())
+                    'S': guid
                 },
                 'expiresOn': {
                     'N': str(expiresOn.timestamp())
@@ -50,37 +44,159 @@ class LockerClient():
                     'N': str(ttl.timestamp())
                 }
             },
-            'TableName': self.lockTableName
+            'TableName': self.lockTableName,
+            'ConditionExpression': 'attribute_not_exists(#name) OR expiresOn < :now',
+            'ExpressionAttributeNames': {
+                '#name': 'name'
+            },
+            'ExpressionAttributeValues': {
+                ':now': {
+                    'N': str(now.timestamp())
+                }
+            }
         }
+        # Whoever the lock is taken for, so that only they release it
+        if owner is not None:
+            put_item_params['Item']['owner'] = {'S': owner}
 
         try:
-            data = self.db.get_item(**get_item_params)
-
-            if 'Item' not in data:
-                # Table exists, but lock not found. We'll try to add a lock
-                # If by the time we try to add we find that the attribute guid exists (because another client grabbed it), the lock will not be added
-                put_item_params['ConditionExpression'] = 'attribute_not_exists(guid)'
-
-            # We know there's possibly a lock'. Check to see it's expired yet
-            elif float(data['Item']['expiresOn']['N']) > now.timestamp():
-                return False
-            else:
-                # We know there's possibly a lock and it's expired. We'll take over.
-                # This is an atomic conditional update
-                print("Expired lock found. Attempting to aquire")
+            self.db.put_item(**put_item_params)
+        except self.db.exceptions.ConditionalCheckFailedException:
+            # Lock is held by someone else
+            return False
         except Exception as e:
             print("Exception" + str(e))
             # Something nasty happened. Possibly table not found
             return False
 
-        # now we're going to try to get the lock. If ANY exception happens, we assume no lock
+        self.guids[lockName] = guid
+        return True
+
+    def try_acquire_many(self, lockNames, expiresOn=None, owners=None):
+        """
+        Try to acquire several locks at once, each for its owner in
+        `owners` if given, returns the names acquired
+        """
+        lockNames = list(lockNames)
+        if not lockNames:
+            return []
+
+        owners = owners or {}
+        with ThreadPoolExecutor(max_workers=min(len(lockNames), 10)) as executor:
+            results = list(executor.map(
+                lambda name: self.get_lock(name, expiresOn, owners.get(name)), lockNames))
+
+        return [name for name, acquired in zip(lockNames, results) if acquired]
+
+    def is_held(self, lockName, owner=None):
+        """
+        Check if a lock is held, by `owner` if given, and hasn't expired
+        """
+        response = self.db.get_item(TableName=self.lockTableName,
+            Key={'name': {'S': lockName}}, ConsistentRead=True)
+        item = response.get('Item')
+        if item is None or float(item['expiresOn']['N']) < datetime.utcnow().timestamp():
+            return False
+        return owner is None or item.get('owner', {}).get('S') == owner
+
+    def take_slot(self, poolName, member, size):
+        """
+        Take one of the `size` slots of a pool for `member`, with a single
+        conditional write on the pool's item. Returns False if every slot
+        is taken. Taking a slot `member` already holds succeeds
+        """
         try:
-            self.db.put_item(**put_item_params)
+            self.db.update_item(TableName=self.lockTableName,
+                Key={'name': {'S': poolName}},
+                UpdateExpression='ADD #taken :member',
+                ConditionExpression='attribute_not_exists(#taken) OR contains(#taken, :memberName) '
+                    'OR size(#taken) < :size',
+                ExpressionAttributeNames={'#taken': 'taken'},
+                ExpressionAttributeValues={
+                    ':member': {'SS': [member]},
+                    ':memberName': {'S': member},
+                    ':size': {'N': str(size)}
+                })
+            return True
+        except self.db.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def give_slot(self, poolName, member):
+        """
+        Give back the slot of a pool held by `member`, if it holds one
+        """
+        try:
+            self.db.update_item(TableName=self.lockTableName,
+                Key={'name': {'S': poolName}},
+                UpdateExpression='DELETE #taken :member',
+                ExpressionAttributeNames={'#taken': 'taken'},
+                ExpressionAttributeValues={':member': {'SS': [member]}})
+        except Exception as e:
+            print(str(e))
+
+    def slots_taken(self, poolName):
+        """
+        Return the members holding a slot of a pool
+        """
+        response = self.db.get_item(TableName=self.lockTableName,
+            Key={'name': {'S': poolName}}, ConsistentRead=True)
+        return response.get('Item', {}).get('taken', {}).get('SS', [])
+
+    def renew_lock(self, lockName, expiresOn=None, guid=None):
+        """
+        Extend a lock that is still held. If the lock was acquired through
+        this client (or `guid` is given), it is only renewed for that holder
+        """
+        now = datetime.utcnow()
+        if not expiresOn:
+            expiresOn = now + timedelta(hours=6)
+        ttl = max(expiresOn, now + timedelta(hours=6))
+
+        guid = guid or self.guids.get(lockName)
+        values = {
+            ':expiresOn': {
+                'N': str(expiresOn.timestamp())
+            },
+            ':ttl': {
+                'N': str(ttl.timestamp())
+            },
+            ':now': {
+                'N': str(now.timestamp())
+            }
+        }
+        condition = 'attribute_exists(#name) AND expiresOn >= :now'
+        if guid:
+            condition += ' AND guid = :guid'
+            values[':guid'] = {'S': guid}
+
+        update_item_params = {
+            'Key': {
+                'name': {
+                    'S': lockName,
+                }
+            },
+            'TableName': self.lockTableName,
+            'UpdateExpression': 'SET expiresOn = :expiresOn, #ttl = :ttl',
+            'ConditionExpression': condition,
+            'ExpressionAttributeNames': {
+                '#name': 'name',
+                '#ttl': 'ttl'
+            },
+            'ExpressionAttributeValues': values
+        }
+
+        try:
+            self.db.update_item(**update_item_params)
             return True
-        except Exception:
+        except Exception as e:
+            print(str(e))
             return False
 
-    def release_lock(self, lockName):
+    def release_lock(self, lockName, owner=None):
+        """
+        Release a lock, only if `owner` holds it when given. Returns
+        whether it was released
+        """
         delete_item_params = {
             'Key': {
                 'name': {
@@ -89,8 +205,26 @@ class LockerClient():
             },
             'TableName': self.lockTableName
         }
+        if owner is not None:
+            delete_item_params.update({
+                # Locks taken without an owner can still be released
+                'ConditionExpression': 'attribute_not_exists(#owner) OR #owner = :owner',
+                'ExpressionAttributeNames': {
+                    '#owner': 'owner'
+                },
+                'ExpressionAttributeValues': {
+                    ':owner': {
+                        'S': owner
+                    }
+                }
+            })
 
         try:
             self.db.delete_item(**delete_item_params)
+            return True
+        except self.db.exceptions.ConditionalCheckFailedException:
+            print(f"Lock {lockName} is no longer held by {owner}")
+            return False
         except Exception as e:
             print(str(e))
+            return False
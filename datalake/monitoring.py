@@ -1,58 +1,285 @@
 import boto3
 import json
+import threading
+import time
 import traceback
 import os
 
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
 from pyutils import pick
 from datetime import datetime
 
+# Task being processed by the current thread or coroutine
+current_task = ContextVar('current_task', default=None)
+# Guards counters rolling up from tasks running in several threads
+counters_lock = threading.Lock()
+
 class MonitoringSettings:
     global_settings = None
     topic_factory = lambda: os.environ.get('sns_monitoring_topic', None)
+    # CloudWatch namespace of the span metrics printed in embedded metric
+    # format, empty to turn them off
+    metrics_namespace_factory = lambda: os.environ.get('monitoring_metrics_namespace', 'DataLake')
+    # Seconds between background flushes of buffered events, 0 flushes
+    # only when a batch is full or on `flush`
+    flush_interval_factory = lambda: float(os.environ.get('monitoring_flush_interval', 0))
 
-    __slots__ = ['monitoring_topic']
+    __slots__ = ['monitoring_topic', 'flush_interval', 'metrics_namespace']
 
     @classmethod
     def get_global(cls):
         if cls.global_settings is None:
-            cls.global_settings = cls(monitoring_topic=cls.topic_factory())
+            cls.global_settings = cls(monitoring_topic=cls.topic_factory(),
+                flush_interval=cls.flush_interval_factory(),
+                metrics_namespace=cls.metrics_namespace_factory())
         
         return cls.global_settings
 
-    def __init__(self, monitoring_topic=None):
+    def __init__(self, monitoring_topic=None, flush_interval=0, metrics_namespace=None):
         self.monitoring_topic = monitoring_topic
+        self.flush_interval = flush_interval
+        self.metrics_namespace = metrics_namespace
+
+class EventBuffer:
+    """
+    Collects monitoring events for a topic and publishes them with
+    PublishBatch, up to 10 per call, when a batch is full, on `flush` or
+    from a background thread every `flush_interval` seconds. Handlers must
+    flush before returning, the container may be frozen right after.
+    """
+    batch_size = 10
+    buffers = {}
+    buffers_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, topic_arn: str, flush_interval: float = 0):
+        """
+        Buffer shared by every task publishing to `topic_arn`
+        """
+        with cls.buffers_lock:
+            if topic_arn not in cls.buffers:
+                cls.buffers[topic_arn] = cls(topic_arn, flush_interval)
+            return cls.buffers[topic_arn]
+
+    @classmethod
+    def flush_all(cls):
+        for buffer in list(cls.buffers.values()):
+            buffer.flush()
+
+    def __init__(self, topic_arn: str, flush_interval: float = 0):
+        self.topic_arn = topic_arn
+        self.sns = boto3.client('sns')
+        self.events = []
+        self.lock = threading.Lock()
+        self.flush_interval = flush_interval
+        if flush_interval:
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def emit(self, message: dict):
+        with self.lock:
+            self.events.append(json.dumps(message))
+            full = len(self.events) >= self.batch_size
+
+        # With a background thread, emitting never waits on SNS
+        if full and not self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            events, self.events = self.events, []
+
+        for start in range(0, len(events), self.batch_size):
+            batch = events[start:start + self.batch_size]
+            try:
+                response = self.sns.publish_batch(TopicArn=self.topic_arn,
+                    PublishBatchRequestEntries=[{'Id': str(i), 'Message': message}
+                        for i, message in enumerate(batch)])
+                for failed in response.get('Failed', []):
+                    print(f"Monitoring event failed: {failed.get('Code')} {failed.get('Message')}")
+            except Exception:
+                print("Monitoring failed")
+                traceback.print_exc()
+
+@contextmanager
+def span(name: str, **counts):
+    """
+    Time a block as a span of the current task. The block may fill in the
+    'bytes' and 'lines' of the yielded counts. Nothing is recorded when
+    no task is current
+    """
+    started = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        task = Task.current()
+        if task is not None:
+            task.record(name, time.perf_counter() - started, **counts)
+
+def submit(executor, fn, *args, **kwargs):
+    """
+    Submit work to a thread pool along with a copy of the current context,
+    so that it runs under the current task
+    """
+    return executor.submit(copy_context().run, fn, *args, **kwargs)
+
+def flush():
+    """
+    Publish every buffered monitoring event
+    """
+    EventBuffer.flush_all()
 
 class Task:
+    """
+    Monitoring of a unit of work, e.g. an archive. The current task is
+    context-local, so concurrent ingestions in threads or coroutines each
+    see their own. Work submitted to a thread pool must go through
+    `submit` to carry the current task along.
+
+    Child tasks (e.g. one per interface) share the parent's identity,
+    have their own timing and counters, and roll their counters up into
+    the parent.
+
+    Timed spans (see `span`) are attached to the next event of the task
+    and printed as CloudWatch embedded metric format lines.
+    """
     __partition_fields = ["country", "year", "month", "day", "secs"]
-    __current = None
 
     @classmethod
     def current(cls):
-        return cls.__current
+        return current_task.get()
     
     @classmethod
     def track(cls, system: str, **params):
-        cls.__current = cls(system, params)
+        """
+        Make a new task current for the rest of the context
+        """
+        task = cls(system, params)
+        current_task.set(task)
+        return task
+
+    @classmethod
+    def scope(cls, system: str, **params):
+        """
+        Context manager making a new task current within its block
+        """
+        return cls(system, params).activate()
 
     def __init__(self, system: str, params: dict):
         settings = params.get('settings')
         if params.get('settings') is None:
             settings = MonitoringSettings.get_global()
 
-        if settings.monitoring_topic is None:
-            self.sns = None
-            self.topic = None
-            return
-
         self.system = system
         self.params = params
-        self.sns = boto3.resource('sns')
-        self.topic = self.sns.Topic(settings.monitoring_topic)
+        self.parent = None
+        self.counters = {}
+        self.spans = []
+        self.started_at = time.time()
+        self.metrics_namespace = settings.metrics_namespace
         self.execution_id = self.get_execution_id()
         self.attempt = self.params.get('attempt', 0)
         self.flow_id = self.get_flow_id()
         self.id = f"{self.system}:{self.flow_id}:{self.execution_id}"
 
+        self.buffer = None
+        if settings.monitoring_topic is not None:
+            self.buffer = EventBuffer.get(settings.monitoring_topic, settings.flush_interval)
+
+    @contextmanager
+    def activate(self):
+        """
+        Make this task current within the block
+        """
+        token = current_task.set(self)
+        try:
+            yield self
+        finally:
+            current_task.reset(token)
+
+    def child(self, **params):
+        """
+        Task for a part of this one, identified by `params`
+        """
+        child = Task(self.system, dict(self.params, **params))
+        child.parent = self
+        return child
+
+    def count(self, **counts):
+        """
+        Add to the counters of this task and of its ancestors
+        """
+        with counters_lock:
+            task = self
+            while task is not None:
+                for name, value in counts.items():
+                    task.counters[name] = task.counters.get(name, 0) + value
+                task = task.parent
+
+    def elapsed(self) -> float:
+        return time.time() - self.started_at
+
+    def record(self, name: str, seconds: float, **counts):
+        """
+        Record a timed span of this task, with optional counts. Throughputs
+        are derived from 'bytes' and 'lines', other counts (e.g. 'parts')
+        are kept as they are
+        """
+        span = {'name': name, 'seconds': round(seconds, 6)}
+        for unit, value in counts.items():
+            if value is None or unit in span:
+                continue
+            span[unit] = value
+            if unit in ('bytes', 'lines') and seconds > 0:
+                span[f"{unit}_per_second"] = round(value / seconds, 1)
+
+        # Printed under the lock too, so lines from several threads don't interleave
+        with counters_lock:
+            self.spans.append(span)
+            if self.metrics_namespace:
+                print(json.dumps(self.metric(span)))
+
+    def metric(self, span: dict) -> dict:
+        """
+        CloudWatch embedded metric format document for a span
+        """
+        units = {
+            'seconds': ('Duration', 'Seconds'),
+            'bytes': ('Bytes', 'Bytes'),
+            'lines': ('Lines', 'Count'),
+            'bytes_per_second': ('BytesPerSecond', 'Bytes/Second'),
+            'lines_per_second': ('LinesPerSecond', 'Count/Second')
+        }
+        # Any other count is a plain Count metric, e.g. rewritten -> Rewritten
+        for field in span:
+            if field not in units and field != 'name':
+                units[field] = (''.join(word.capitalize() for word in field.split('_')), 'Count')
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.metrics_namespace,
+                    'Dimensions': [['System', 'Phase']],
+                    'Metrics': [{'Name': units[field][0], 'Unit': units[field][1]}
+                        for field in units if field in span]
+                }]
+            },
+            'System': self.system,
+            'Phase': span['name'],
+            'TaskId': self.id
+        }
+        if self.params.get('interface'):
+            document['Interface'] = self.params['interface']
+        for field, (name, _) in units.items():
+            if field in span:
+                document[name] = span[field]
+        return document
+
     def get_flow_id(self):
         columns = self.__partition_fields
         return "/".join(map(lambda col: f"{col}={self.params[col]}", columns))
@@ -73,7 +300,7 @@ class Task:
         return base
 
     def __event(self, status: str, ok: bool, payload: dict):
-        if self.topic is not None:
+        if self.buffer is not None:
             try:
                 message = {}
                 message['id'] = self.id
@@ -83,8 +310,15 @@ class Task:
                 message['system'] = self.system
                 message['partitions'] = pick(self.params, *self.__partition_fields)
                 message['payload'] = payload
+                message['elapsed'] = round(self.elapsed(), 3)
+                if self.counters:
+                    message['counters'] = dict(self.counters)
+                with counters_lock:
+                    spans, self.spans = self.spans, []
+                if spans:
+                    message['spans'] = spans
 
-                self.topic.publish(Message=json.dumps(message))
+                self.buffer.emit(message)
             except Exception:
                 print("Monitoring failed")
                 traceback.print_exc()
@@ -0,0 +1,86 @@
+# Conversion of interface text to Parquet, only available with pyarrow
+from typing import List
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Rows buffered before they are written out as a row group
+DEFAULT_ROW_GROUP_SIZE = 64 * 1024
+
+def available() -> bool:
+    return pyarrow is not None
+
+class ParquetConversionError(Exception):
+    pass
+
+class TextToParquet:
+    """
+    Converts tab separated, CRLF terminated text fed in chunks into an in
+    memory Parquet file, one row group every `row_group_size` rows. Every
+    column is a string, like in the tables built from FMT specs. The first
+    row that doesn't fit the columns stops the conversion; `error` then
+    says why and `finish` returns None.
+    """
+
+    def __init__(self, columns: List[str], row_group_size: int = DEFAULT_ROW_GROUP_SIZE):
+        self.columns = columns
+        self.row_group_size = row_group_size
+        self.schema = pyarrow.schema([(column, pyarrow.string()) for column in columns])
+        self.output = pyarrow.BufferOutputStream()
+        self.writer = pyarrow.parquet.ParquetWriter(self.output, self.schema, compression='snappy')
+        self.values = [[] for _ in columns]
+        self.pending = ''
+        self.line = 0
+        self.error = None
+
+    def _add(self, line: str):
+        self.line += 1
+        fields = line.split('\t')
+        if len(fields) != len(self.columns):
+            raise ParquetConversionError(
+                f"line {self.line} has {len(fields)} fields, expected {len(self.columns)}")
+        for values, field in zip(self.values, fields):
+            values.append(field)
+
+    def _write_row_group(self):
+        if not self.values[0]:
+            return
+        self.writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(values, type=pyarrow.string()) for values in self.values],
+            schema=self.schema))
+        self.values = [[] for _ in self.columns]
+
+    def feed(self, text: str):
+        if self.error is not None:
+            return
+
+        lines = (self.pending + text).split('\r\n')
+        self.pending = lines.pop()
+        try:
+            for line in lines:
+                self._add(line)
+                if len(self.values[0]) >= self.row_group_size:
+                    self._write_row_group()
+        except (ParquetConversionError, pyarrow.ArrowException) as e:
+            self.error = str(e)
+
+    def finish(self):
+        """
+        Returns the Parquet file, None if the text couldn't be converted
+        """
+        try:
+            if self.error is None:
+                if self.pending:
+                    self._add(self.pending)
+                self._write_row_group()
+        except (ParquetConversionError, pyarrow.ArrowException) as e:
+            self.error = str(e)
+        finally:
+            self.writer.close()
+
+        if self.error is not None:
+            return None
+        return self.output.getvalue().to_pybytes()
@@ -0,0 +1,235 @@
+# Utilities for streaming data to and from S3
+import tempfile
+import time
+
+# S3 rejects multipart parts smaller than 5 MiB (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_SPOOL_SIZE = 64 * 1024 * 1024
+
+def iter_chunks(fileobj, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """
+    Yield successive chunks of at most `chunk_size` bytes from a file-like object
+    """
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def download_spooled(s3, bucket: str, key: str, max_memory: int = DEFAULT_SPOOL_SIZE):
+    """
+    Download an S3 object into a seekable temporary file. The file is kept
+    in memory up to `max_memory` bytes and spilled to /tmp beyond that
+    """
+    tf = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    s3.download_fileobj(bucket, key, tf)
+    tf.seek(0)
+    return tf
+
+class MultipartWriter:
+    """
+    Write-only file-like object that uploads to S3 using multipart upload,
+    holding at most one part in memory. Objects smaller than one part are
+    sent with a single PutObject call instead.
+    """
+
+    def __init__(self, s3, bucket: str, key: str, part_size: int = DEFAULT_CHUNK_SIZE, **extra):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.extra = extra
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(self.part_size)
+        return len(data)
+
+    def _upload_part(self, size: int):
+        if self.upload_id is None:
+            response = self.s3.create_multipart_upload(Bucket=self.bucket,
+                Key=self.key, **self.extra)
+            self.upload_id = response['UploadId']
+
+        with memoryview(self.buffer) as view, view[:size] as part:
+            body = bytes(part)
+        del self.buffer[:size]
+
+        number = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key,
+            UploadId=self.upload_id, PartNumber=number, Body=body)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': number})
+
+    def close(self):
+        if self.closed:
+            return
+
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key,
+                Body=bytes(self.buffer), **self.extra)
+        else:
+            if self.buffer:
+                self._upload_part(len(self.buffer))
+            self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+                UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+
+        self.buffer = bytearray()
+        self.closed = True
+
+    def abort(self):
+        """
+        Discard everything written so far, including uploaded parts
+        """
+        if self.upload_id is not None:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucket,
+                    Key=self.key, UploadId=self.upload_id)
+            except Exception as e:
+                print(f"Failed to abort upload of {self.key}: {e}")
+
+        self.buffer = bytearray()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def balanced_part_size(total: int, target: int) -> int:
+    """
+    Size of the parts that split `total` bytes in as few parts of at most
+    `target` bytes as possible, all about the same size. Returns 0 (no
+    split) when it fits in a single part
+    """
+    if target <= 0 or total <= target:
+        return 0
+    parts = -(-total // target)
+    return -(-total // parts)
+
+class PartWriter:
+    """
+    Write-only file-like object that lands text in S3 compressed with
+    `codec`, as one or more objects. Once a part holds `part_size`
+    uncompressed bytes it ends at the next CRLF and the following lines go
+    to a new object, so that every part can be read on its own even with
+    codecs that can't be split. The first part is named `{stem}{extension}`,
+    the next ones `{stem}-{n}{extension}`. A `part_size` of 0 never rolls
+    over.
+    """
+
+    def __init__(self, s3, bucket: str, stem: str, extension: str, codec,
+            part_size: int = 0, upload_size: int = DEFAULT_CHUNK_SIZE, level: int = None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.stem = stem
+        self.extension = extension
+        self.codec = codec
+        self.part_size = part_size
+        self.upload_size = upload_size
+        self.level = level
+        self.keys = []
+        self.writer = None
+        self.compressor = None
+        self.part_bytes = 0
+        self.line_end = True
+        # Bytes written to S3, and time spent compressing them
+        self.size = 0
+        self.compress_time = 0
+        self.closed = False
+
+    def _open(self):
+        index = len(self.keys)
+        key = f"{self.stem}-{index}{self.extension}" if index else f"{self.stem}{self.extension}"
+        self.keys.append(key)
+        self.writer = MultipartWriter(self.s3, self.bucket, key, self.upload_size)
+        self.compressor = self.codec.compressor(self.level)
+        self.part_bytes = 0
+
+    def _compress(self, data: bytes, final: bool = False):
+        started = time.perf_counter()
+        output = self.compressor.compress(data)
+        if final:
+            output += self.compressor.flush()
+        self.compress_time += time.perf_counter() - started
+        self.part_bytes += len(data)
+        if output:
+            self.writer.write(output)
+
+    def _close_part(self):
+        self._compress(b'', final=True)
+        self.writer.close()
+        self.size += self.writer.size
+        self.writer = None
+
+    def write(self, data) -> int:
+        size = len(data)
+        if not size:
+            return 0
+        if self.writer is None:
+            self._open()
+
+        while self.part_size:
+            # A full part that ended on a line break rolls over right away
+            if self.part_bytes >= self.part_size and self.line_end:
+                self._close_part()
+                self._open()
+            if self.part_bytes + len(data) <= self.part_size:
+                break
+            end = data.find(b'\r\n', max(self.part_size - self.part_bytes - 1, 0))
+            if end == -1 or end + 2 == len(data):
+                break
+            self._compress(data[:end + 2])
+            data = data[end + 2:]
+            self.line_end = True
+
+        self._compress(data)
+        self.line_end = data.endswith(b'\r\n')
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        # Even empty input lands as an (empty) object
+        if self.writer is None:
+            self._open()
+        self._close_part()
+        self.closed = True
+
+    def abort(self):
+        """
+        Discard everything written so far, including completed parts
+        """
+        if self.writer is not None:
+            self.writer.abort()
+            self.writer = None
+            completed = self.keys[:-1]
+        else:
+            completed = self.keys
+        if completed:
+            try:
+                self.s3.delete_objects(Bucket=self.bucket,
+                    Delete={'Objects': [{'Key': key} for key in completed], 'Quiet': True})
+            except Exception as e:
+                print(f"Failed to delete parts of {self.stem}: {e}")
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
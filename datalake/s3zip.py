@@ -0,0 +1,209 @@
+# Random access to zip archives stored in S3 through ranged GETs
+import struct
+import zipfile
+import zlib
+
+from collections import OrderedDict
+
+# Small reads are padded up to this size. The archive tail is prefetched
+# with the same size, which covers the central directory of typical drops
+READAHEAD_SIZE = 64 * 1024
+RAW_CHUNK_SIZE = 1024 * 1024
+
+class S3RangeFile:
+    """
+    Read-only, seekable file-like object backed by ranged GETs on an S3 object.
+    Fetched ranges are kept in a small LRU cache.
+    """
+
+    def __init__(self, s3, bucket: str, key: str, size: int = None,
+            readahead: int = READAHEAD_SIZE, cache_size: int = 4):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        if size is None:
+            size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.size = size
+        self.readahead = readahead
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.position = 0
+        self.closed = False
+
+    def fetch(self, start: int, end: int) -> bytes:
+        """
+        GET bytes [start, end) of the object
+        """
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.key,
+            Range=f"bytes={start}-{end - 1}")
+        return response['Body'].read()
+
+    def prefetch_tail(self, size: int):
+        """
+        Load the last `size` bytes of the object into the cache
+        """
+        self._load(max(0, self.size - size), size)
+
+    def _cached(self, position: int):
+        for start, data in self.cache.items():
+            if start <= position < start + len(data):
+                self.cache.move_to_end(start)
+                return start, data
+        return None, None
+
+    def _load(self, position: int, size: int):
+        end = min(self.size, position + max(size, self.readahead))
+        data = self.fetch(position, end)
+        self.cache[position] = data
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return position, data
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.size - self.position
+        size = min(size, self.size - self.position)
+
+        chunks = []
+        while size > 0:
+            start, data = self._cached(self.position)
+            if data is None:
+                start, data = self._load(self.position, size)
+            chunk = data[self.position - start:self.position - start + size]
+            chunks.append(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+
+        return b''.join(chunks)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def seekable(self) -> bool:
+        return True
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        self.cache.clear()
+        self.closed = True
+
+class S3ZipMember:
+    """
+    Streaming reader for a single zip member. The compressed data is read
+    with one ranged GET covering exactly the member, and inflated on the fly.
+    """
+
+    def __init__(self, s3, bucket: str, key: str, info: zipfile.ZipInfo):
+        if info.flag_bits & 0x1:
+            raise NotImplementedError(f"{info.filename} is encrypted")
+        if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise NotImplementedError(
+                f"{info.filename} uses unsupported compression {info.compress_type}")
+
+        self.info = info
+        self.crc = 0
+        self.eof = info.compress_size == 0
+        self.pending = b''
+        self.body = None
+        self.decompressor = None
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            self.decompressor = zlib.decompressobj(-15)
+
+        # The local header repeats name and extra field, possibly with a
+        # different extra length than the central directory, so read it first
+        header = s3.get_object(Bucket=bucket, Key=key,
+            Range=f"bytes={info.header_offset}-{info.header_offset + zipfile.sizeFileHeader - 1}"
+        )['Body'].read()
+        fields = struct.unpack(zipfile.structFileHeader, header)
+        if fields[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f"Bad local header for {info.filename}")
+
+        start = info.header_offset + zipfile.sizeFileHeader + \
+            fields[zipfile._FH_FILENAME_LENGTH] + fields[zipfile._FH_EXTRA_FIELD_LENGTH]
+        if not self.eof:
+            self.body = s3.get_object(Bucket=bucket, Key=key,
+                Range=f"bytes={start}-{start + info.compress_size - 1}")['Body']
+
+    def _read_raw(self, size: int) -> bytes:
+        if self.pending:
+            raw, self.pending = self.pending, b''
+            return raw
+        return self.body.read(RAW_CHUNK_SIZE if self.decompressor else size)
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(RAW_CHUNK_SIZE), b''))
+
+        data = b''
+        while not data and not self.eof:
+            raw = self._read_raw(size)
+            if not raw:
+                data = self.decompressor.flush() if self.decompressor else b''
+                self.eof = True
+            elif self.decompressor:
+                data = self.decompressor.decompress(raw, size)
+                self.pending = self.decompressor.unconsumed_tail
+            else:
+                data = raw
+            self.crc = zlib.crc32(data, self.crc)
+
+        if self.eof and self.crc != self.info.CRC:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for {self.info.filename}")
+        return data
+
+    def close(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class S3ZipReader:
+    """
+    Zip archive in S3 that only downloads its central directory and the
+    byte ranges of the members that are actually opened. Exposes the
+    `infolist`/`open` subset of `zipfile.ZipFile`.
+    """
+
+    def __init__(self, s3, bucket: str, key: str, size: int = None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.file = S3RangeFile(s3, bucket, key, size)
+        self.file.prefetch_tail(READAHEAD_SIZE)
+        self.zipf = zipfile.ZipFile(self.file, mode='r')
+
+    def infolist(self):
+        return self.zipf.infolist()
+
+    def getinfo(self, name: str) -> zipfile.ZipInfo:
+        return self.zipf.getinfo(name)
+
+    def open(self, member) -> S3ZipMember:
+        if not isinstance(member, zipfile.ZipInfo):
+            member = self.getinfo(member)
+        return S3ZipMember(self.s3, self.bucket, self.key, member)
+
+    def close(self):
+        self.zipf.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,311 @@
+# Step DAG: which Spark steps run for a partition and in which order
+import boto3
+import json
+
+from datetime import datetime, timedelta
+
+# Node reached once every other node of the DAG completed
+JOIN_NODE = 'final'
+
+def node_id(step, task):
+    """
+    DAG node of a step job: the step, plus the interface for fanned out steps
+    """
+    return f"{step}:{task['interface']}" if task.get('interface') else step
+
+def parse_node(node):
+    """
+    Split a DAG node into its step and interface (None if not fanned out)
+    """
+    step, _, interface = node.partition(':')
+    return step, interface or None
+
+def with_interface(task, interface):
+    task = {key: value for key, value in task.items() if key != 'interface'}
+    if interface:
+        task['interface'] = interface
+    return task
+
+def linear_spec(chain):
+    """
+    DAG equivalent to a linear {step: next step} chain starting at 'initial'
+    """
+    spec = {}
+    previous = None
+    step = chain['initial']
+    while step != JOIN_NODE:
+        spec[step] = {'after': [previous] if previous else []}
+        previous, step = step, chain[step]
+    return spec
+
+def load_spec(value, chain, steps):
+    """
+    Parse a DAG definition like
+    {"load_parquet_partition": {"per_interface": true},
+     "load_redshift_partition": {"after": ["load_parquet_partition"], "per_interface": true},
+     "load_functional": {"after": ["load_redshift_partition"]}}
+    falling back to the linear `chain` when `value` is empty. Every node
+    must be one of `steps`
+    """
+    spec = json.loads(value) if value else linear_spec(chain)
+
+    for step, node in spec.items():
+        if step not in steps:
+            raise ValueError(f"Unknown step {step} in step DAG")
+        for parent in node.get('after', []):
+            if parent not in spec:
+                raise ValueError(f"Unknown dependency {parent} of {step} in step DAG")
+
+    # Kahn's algorithm, anything left over is part of a cycle
+    remaining = {step: set(node.get('after', [])) for step, node in spec.items()}
+    while remaining:
+        roots = [step for step, parents in remaining.items() if not parents]
+        if not roots:
+            raise ValueError(f"Cycle between {', '.join(sorted(remaining))} in step DAG")
+        for step in roots:
+            del remaining[step]
+        for parents in remaining.values():
+            parents.difference_update(roots)
+
+    return spec
+
+class StepDag():
+    """
+    Runs the steps of a partition as a DAG. Steps marked 'per_interface'
+    fan out into one job per interface ingested into the partition (every
+    interface of the system for tasks that don't name them); a fanned out step
+    that depends on another fanned out step only waits for the same
+    interface, so slow interfaces don't hold up the others.
+
+    The state of every execution is kept in the lock table (as
+    'emrsteps:dag:{country}:{execution_id}' items): the nodes completed and
+    the nodes claimed, and the interfaces fanned out over. Nodes are claimed with conditional writes, so when
+    parallel branches complete at the same time each ready node is still
+    submitted only once. The join node is claimed once everything else
+    completed, by whoever then releases the country.
+
+    Once a node failed for good the execution is failed: nothing else is
+    claimed, and the branches still running settle as they end, whatever
+    their outcome. The join node is then claimed once every claimed node
+    completed or settled.
+
+    Root nodes of `converted_step` whose interfaces were all converted to
+    Parquet at ingestion are done from the start, without a job.
+
+    Executions started before the DAG existed have no state; their
+    callbacks follow the linear `chain` they were started on.
+    """
+
+    prefix = 'emrsteps:dag:'
+
+    def __init__(self, tableName, spec, interfaces, chain, converted_step=None):
+        self.tableName = tableName
+        self.spec = spec
+        self.interfaces = interfaces
+        self.chain = chain
+        self.converted_step = converted_step
+        self.db = boto3.client('dynamodb')
+
+    def key(self, task):
+        return {
+            'name': {
+                'S': f"{self.prefix}{task['country']}:{task['execution_id']}"
+            }
+        }
+
+    def system_interfaces(self, system):
+        interfaces = self.interfaces.get(system, ())
+        # A single interface may be written as a plain string
+        return (interfaces,) if isinstance(interfaces, str) else tuple(interfaces)
+
+    def task_interfaces(self, task):
+        return tuple(sorted(task.get('interfaces') or self.system_interfaces(task['system'])))
+
+    def state_interfaces(self, task, state):
+        return tuple(sorted(state.get('interfaces', {}).get('SS', []))) or \
+            self.system_interfaces(task['system'])
+
+    def instances(self, interfaces):
+        """
+        Expand the DAG over interfaces into {node: (step, interface, dependencies)}
+        """
+        def interfaces_of(step):
+            if self.spec[step].get('per_interface'):
+                return interfaces
+            return (None,)
+
+        nodes = {}
+        for step, spec in self.spec.items():
+            for interface in interfaces_of(step):
+                dependencies = []
+                for parent in spec.get('after', []):
+                    if interface and self.spec[parent].get('per_interface'):
+                        dependencies.append(f"{parent}:{interface}")
+                    else:
+                        dependencies.extend(node_id(parent, {'interface': parent_interface})
+                            for parent_interface in interfaces_of(parent))
+                node = node_id(step, {'interface': interface})
+                nodes[node] = (step, interface, dependencies)
+        return nodes
+
+    def jobs(self, task, nodes, instances):
+        return [(instances[node][0], with_interface(task, instances[node][1]))
+            for node in nodes]
+
+    def converted(self, task, instances):
+        """
+        Root nodes of `converted_step` with nothing left to do, as every
+        interface they cover was converted to Parquet at ingestion
+        """
+        converted = set(task.get('parquet_interfaces') or ())
+        ingested = set(task.get('interfaces') or ())
+        return [node for node, (step, interface, dependencies) in instances.items()
+            if step == self.converted_step and not dependencies
+                and (interface in converted if interface else ingested and ingested <= converted)]
+
+    def start(self, task):
+        """
+        Record a new execution, returns the (step, task) jobs of its root
+        nodes. Nodes done at ingestion are recorded as done right away,
+        no jobs means the execution has nothing left to run
+        """
+        interfaces = self.task_interfaces(task)
+        instances = self.instances(interfaces)
+        done = self.converted(task, instances)
+        roots = [node for node, (_, _, dependencies) in instances.items()
+            if node not in done and set(dependencies) <= set(done)]
+        now = datetime.utcnow()
+
+        item = {
+            **self.key(task),
+            'claimed': {
+                'SS': roots + done + ([JOIN_NODE] if not roots else [])
+            },
+            'startedAt': {
+                'N': str(now.timestamp())
+            },
+            'ttl': {
+                'N': str((now + timedelta(days=2)).timestamp())
+            }
+        }
+        # Callbacks expand the DAG over the same interfaces
+        if interfaces:
+            item['interfaces'] = {'SS': list(interfaces)}
+        if done:
+            item['done'] = {'SS': done}
+        self.db.put_item(TableName=self.tableName, Item=item)
+
+        return self.jobs(task, roots, instances)
+
+    def claim(self, task, node):
+        condition = 'attribute_exists(#name) AND NOT contains(claimed, :nodeName)'
+        if node != JOIN_NODE:
+            # Failed executions only go on to the join node
+            condition += ' AND attribute_not_exists(failed)'
+        try:
+            self.db.update_item(TableName=self.tableName, Key=self.key(task),
+                UpdateExpression='ADD claimed :node',
+                ConditionExpression=condition,
+                ExpressionAttributeNames={'#name': 'name'},
+                ExpressionAttributeValues={
+                    ':node': {'SS': [node]},
+                    ':nodeName': {'S': node}
+                })
+            return True
+        except self.db.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def state(self, task):
+        return self.db.get_item(TableName=self.tableName, Key=self.key(task),
+            ConsistentRead=True).get('Item')
+
+    def is_failed(self, task):
+        return 'failed' in (self.state(task) or {})
+
+    def settled(self, task, state):
+        """
+        Claim the join node of a failed execution if no claimed node is
+        still running, returns whether this call claimed it
+        """
+        ended = set(state.get('done', {}).get('SS', [])) | set(state.get('settled', {}).get('SS', []))
+        if set(state['claimed']['SS']) - ended - {JOIN_NODE}:
+            return False
+        return self.claim(task, JOIN_NODE)
+
+    def complete(self, step, task):
+        """
+        Record a completed node. Returns the (step, task) jobs that became
+        ready, and whether this completion finished the whole DAG
+        """
+        node = node_id(step, task)
+        try:
+            state = self.db.update_item(TableName=self.tableName, Key=self.key(task),
+                UpdateExpression='ADD done :node',
+                ConditionExpression='attribute_exists(#name) AND attribute_not_exists(failed)',
+                ExpressionAttributeNames={'#name': 'name'},
+                ExpressionAttributeValues={':node': {'SS': [node]}},
+                ReturnValues='ALL_NEW')['Attributes']
+        except self.db.exceptions.ConditionalCheckFailedException:
+            if self.state(task):
+                print(f"Execution {task['execution_id']} for {task['country']} failed, settling {node}")
+                return [], self.settle(step, task)
+            following = self.chain.get(step, JOIN_NODE)
+            print(f"No DAG state for execution {task['execution_id']} of {task['country']}, "
+                f"following the linear chain to {following}")
+            if following == JOIN_NODE:
+                return [], True
+            return [(following, with_interface(task, None))], False
+
+        done = set(state['done']['SS'])
+        claimed = set(state['claimed']['SS'])
+        instances = self.instances(self.state_interfaces(task, state))
+
+        if done.issuperset(instances):
+            return [], self.claim(task, JOIN_NODE)
+
+        ready = [other for other, (_, _, dependencies) in instances.items()
+            if other not in claimed and done.issuperset(dependencies)]
+        return self.jobs(task, [other for other in ready if self.claim(task, other)], instances), False
+
+    def settle(self, step, task):
+        """
+        Record that a node of a failed execution ended. Returns whether
+        this was the last one running, in which case the caller releases
+        the country
+        """
+        try:
+            state = self.db.update_item(TableName=self.tableName, Key=self.key(task),
+                UpdateExpression='ADD settled :node',
+                ConditionExpression='attribute_exists(failed)',
+                ExpressionAttributeValues={':node': {'SS': [node_id(step, task)]}},
+                ReturnValues='ALL_NEW')['Attributes']
+        except self.db.exceptions.ConditionalCheckFailedException:
+            return False
+        return self.settled(task, state)
+
+    def fail(self, step, task):
+        """
+        Stop an execution after a node failed for good, so that branches
+        still running don't start anything else. Returns whether this
+        call failed the execution (rather than another branch failing it
+        first) and whether no other node is still running, in which case
+        the caller releases the country
+        """
+        node = node_id(step, task)
+        try:
+            state = self.db.update_item(TableName=self.tableName, Key=self.key(task),
+                UpdateExpression='SET failed = :now ADD settled :node',
+                ConditionExpression='attribute_exists(#name) AND attribute_not_exists(failed)',
+                ExpressionAttributeNames={'#name': 'name'},
+                ExpressionAttributeValues={
+                    ':now': {'N': str(datetime.utcnow().timestamp())},
+                    ':node': {'SS': [node]}
+                },
+                ReturnValues='ALL_NEW')['Attributes']
+        except self.db.exceptions.ConditionalCheckFailedException:
+            if self.state(task):
+                # Another branch failed it first
+                return False, self.settle(step, task)
+            # Executions without DAG state have nothing else to stop
+            return True, True
+        return True, self.settled(task, state)
@@ -0,0 +1,64 @@
+# Byte level checks of interface text
+import codecs
+
+ASCII = bytes(range(128))
+
+def is_ascii(data: bytes) -> bool:
+    """
+    Check if data is pure ASCII, thus valid UTF-8, without decoding it
+    """
+    if hasattr(data, 'isascii'):
+        return data.isascii()
+    # bytes.isascii is 3.7+, deleting every ASCII byte leaves nothing
+    return not data.translate(None, ASCII)
+
+class Utf8Sanitizer:
+    """
+    Validates UTF-8 fed in chunks. Valid chunks come back untouched, chunks
+    with invalid sequences are rewritten with U+FFFD in their place. A
+    sequence cut at the end of a chunk is held back and comes out as a
+    separate piece in front of the next one, so valid chunks are never
+    copied to be joined
+    """
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')('strict')
+        self.replacer = codecs.getincrementaldecoder('utf-8')('replace')
+        # Chunks that had to be rewritten
+        self.rewritten = 0
+
+    def feed(self, chunk: bytes, final: bool = False) -> list:
+        """
+        Returns the valid pieces of bytes to write for a chunk
+        """
+        pending, flags = self.decoder.getstate()
+        if not pending and not final and is_ascii(chunk):
+            return [chunk]
+
+        try:
+            self.decoder.decode(chunk, final)
+        except UnicodeDecodeError:
+            self.decoder.reset()
+            self.replacer.setstate((pending, flags))
+            text = self.replacer.decode(chunk, final)
+            self.decoder.setstate(self.replacer.getstate())
+            self.rewritten += 1
+            return [text.encode('utf-8')] if text else []
+
+        held = len(self.decoder.getstate()[0])
+        if held and held >= len(chunk):
+            # The sequence held back before is still incomplete
+            return []
+        pieces = [pending] if pending else []
+        if held:
+            # Only a chunk ending mid sequence gets copied
+            chunk = chunk[:len(chunk) - held]
+        if chunk:
+            pieces.append(chunk)
+        return pieces
+
+    def finish(self) -> list:
+        """
+        Returns what is still held back, replaced if it never completed
+        """
+        return self.feed(b'', final=True)